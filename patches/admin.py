@@ -54,7 +54,7 @@ class PatchImageAdmin(admin.ModelAdmin):
         ]
 
 class PatchAttachAdmin(admin.ModelAdmin):
-    search_fields = ('file',)
+    search_fields = ('file', 'original_name')
     fields = ['file']
 
 class PatchAuthorNameAdmin(admin.ModelAdmin):
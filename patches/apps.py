@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class PatchesConfig(AppConfig):
     name = 'patches'
+
+    def ready(self):
+        from . import signals
@@ -0,0 +1,201 @@
+"""
+Generation counters for invalidating cached responses.
+
+Each generation is a timestamp in whole seconds kept in the Django cache.
+Cache keys built from the current generation stop matching as soon as it
+is bumped, so nothing has to be deleted, and the timestamp doubles as the
+Last-Modified time of anything built from the data it covers. Bumps are
+strictly increasing, so two changes in the same second still give
+different Last-Modified times.
+
+Generations are kept in the 'generations' cache if there is one, away from
+the culling of the default cache. If a generation is lost anyway it is
+restarted after the current time, so nothing cached before can match it.
+
+AnonymousCacheMixin uses them to cache whole pages for anonymous visitors.
+
+acquire_lock and release_lock give one worker at a time a named job, such
+as rebuilding a page. With PATCHES_LOCK_DIR set a lock is a file created
+with O_CREAT | O_EXCL, which is atomic on every worker sharing the
+directory. Without it the default cache's add is used, which is only
+atomic on backends like memcached or redis, not FileBasedCache.
+"""
+import os
+import time
+import hashlib
+
+from cms.utils.conf import get_cms_setting
+from django.contrib import messages
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.http import HttpResponse
+
+from tttweb.templatetags.tttcms_tags import sorted_querystring
+
+key_prefix = 'patches:generation:'
+
+def get_generation_cache():
+    if 'generations' in settings.CACHES:
+        return caches['generations']
+    return cache
+
+def get_generation(name):
+    """
+    Return the current generation of name
+    """
+    generations = get_generation_cache()
+    key = key_prefix+name
+    generation = generations.get(key)
+    if generation is None:
+        #Lost or never set. Start a new one past anything bumped this second
+        #so nothing stale can match
+        generations.add(key, int(time.time())+1, None)
+        generation = generations.get(key)
+    return generation
+
+def bump_generation(name):
+    """
+    Invalidate everything cached under the current generation of name
+    """
+    generations = get_generation_cache()
+    key = key_prefix+name
+    generation = int(time.time())
+    previous = generations.get(key)
+    if previous is not None:
+        generation = max(generation, int(previous)+1)
+    generations.set(key, generation, None)
+    return generation
+
+def get_toolbar_params():
+    """
+    Return the querystring parameters that switch django-cms' toolbar modes
+    """
+    names = ['TOOLBAR_URL__EDIT_ON', 'TOOLBAR_URL__EDIT_OFF', 'TOOLBAR_URL__BUILD', 'TOOLBAR_URL__DISABLE']
+    return {get_cms_setting(x) for x in names} | {'toolbar_on'}
+
+def make_key(*parts):
+    """
+    Return a cache key for the given parts, hashed to stay short and safe
+    for every backend
+    """
+    digest = hashlib.md5(':'.join(str(x) for x in parts).encode()).hexdigest()
+    return f'patches:{digest}'
+
+def get_lock_path(name):
+    lock_dir = settings.PATCHES_LOCK_DIR
+    os.makedirs(lock_dir, exist_ok=True)
+    return os.path.join(lock_dir, hashlib.md5(name.encode()).hexdigest()+'.lock')
+
+def acquire_lock(name, timeout):
+    """
+    Take the lock called name if no one holds it and return True, otherwise
+    return False. A lock older than timeout seconds is taken to belong to a
+    worker that died and is broken.
+    """
+    if getattr(settings, 'PATCHES_LOCK_DIR', None) is None:
+        return cache.add(make_key('lock', name), True, timeout)
+    path = get_lock_path(name)
+    for _ in range(2):
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            pass
+        try:
+            if time.time()-os.path.getmtime(path) < timeout:
+                return False
+            os.unlink(path)
+        except FileNotFoundError:
+            #Released in between, try again
+            pass
+    return False
+
+def release_lock(name):
+    if getattr(settings, 'PATCHES_LOCK_DIR', None) is None:
+        cache.delete(make_key('lock', name))
+        return
+    try:
+        os.unlink(get_lock_path(name))
+    except FileNotFoundError:
+        pass
+
+class AnonymousCacheMixin:
+    """
+    View mixin caching whole responses to anonymous GET requests. Keys use
+    the sorted querystring and entries are checked against the generations
+    named in cache_generations, so any change they cover invalidates every
+    page at once.
+
+    When a page has to be rebuilt only the worker holding its lock, see
+    acquire_lock, renders it. Others serve the stale copy if there is one,
+    or wait briefly for the new one.
+
+    Requests for the django-cms toolbar and pages that used the CSRF token
+    are never cached, so one visitor's token can't be served to another.
+    """
+    cache_generations = ('entries',)
+    cache_timeout = 60*10
+    lock_timeout = 30
+    lock_wait = 2
+
+    def is_cacheable_request(self, request):
+        if request.method not in ('GET', 'HEAD'):
+            return False
+        if request.user.is_authenticated:
+            return False
+        if get_toolbar_params() & set(request.GET):
+            return False
+        #Iterating marks messages as read, used = False keeps them queued
+        storage = messages.get_messages(request)
+        pending = len(list(storage))
+        storage.used = False
+        return pending == 0
+
+    def is_cacheable_response(self, request, response):
+        #Cookies set by middleware, including the CSRF cookie, are added
+        #after the response is stored, so check whether the token was used
+        if request.META.get('CSRF_COOKIE_USED'):
+            return False
+        return response.status_code == 200 and not response.cookies and not response.streaming
+
+    def get_response_cache_key(self, request):
+        #Blank values are kept, e.g. ?cursor= switches the index to keyset pages
+        return make_key('page', request.scheme, request.get_host(), request.path,
+            sorted_querystring(request.GET, keep_blank=True))
+
+    def dispatch(self, request, *args, **kwargs):
+        if not self.is_cacheable_request(request):
+            return super().dispatch(request, *args, **kwargs)
+
+        generation = [get_generation(x) for x in self.cache_generations]
+        key = self.get_response_cache_key(request)
+        cached = cache.get(key)
+        if cached is not None and cached[0] == generation:
+            return self.cached_response(cached)
+
+        lock = key+':lock'
+        if not acquire_lock(lock, self.lock_timeout):
+            #Someone else is rebuilding this page
+            if cached is not None:
+                return self.cached_response(cached)
+            deadline = time.monotonic()+self.lock_wait
+            while time.monotonic() < deadline:
+                time.sleep(0.05)
+                cached = cache.get(key)
+                if cached is not None and cached[0] == generation:
+                    return self.cached_response(cached)
+            return super().dispatch(request, *args, **kwargs)
+
+        try:
+            response = super().dispatch(request, *args, **kwargs)
+            if hasattr(response, 'render'):
+                response.render()
+            if self.is_cacheable_response(request, response):
+                cache.set(key, (generation, response.content, response['Content-Type']), self.cache_timeout)
+        finally:
+            release_lock(lock)
+        return response
+
+    def cached_response(self, cached):
+        _, content, content_type = cached
+        return HttpResponse(content, content_type=content_type)
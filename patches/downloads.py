@@ -0,0 +1,154 @@
+"""
+Serving media files with byte range and conditional GET support.
+
+Set PATCHES_SENDFILE to hand the body off to the front proxy:
+    'x-accel-redirect' - nginx, with PATCHES_SENDFILE_URL as the internal
+                         location that maps to MEDIA_ROOT
+    'x-sendfile'       - apache mod_xsendfile and lighttpd
+Otherwise the file is streamed from Python without being read into memory.
+"""
+import os
+import re
+import mimetypes
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import HttpResponse, FileResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+
+range_re = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+class RangeFile:
+    """
+    Read-only view of length bytes of fp, starting at its current position
+    """
+    def __init__(self, fp, length):
+        self.fp = fp
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fp.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.fp.close()
+
+def parse_range(header, size):
+    """
+    Return (start, end) inclusive for a single range Range header, None if
+    the header should be ignored, or False if it can't be satisfied
+    """
+    match = range_re.match(header.replace(' ', ''))
+    if not match:
+        #Malformed and multiple ranges get the whole file
+        return None
+    start, end = match.groups()
+    if start == '' and end == '':
+        return None
+    if start == '':
+        #Suffix range, the last n bytes
+        length = int(end)
+        if length == 0:
+            return False
+        return max(size-length, 0), size-1
+    start = int(start)
+    end = size-1 if end == '' else min(int(end), size-1)
+    if start > end or start >= size:
+        return False
+    return start, end
+
+def if_range_matches(request, etag, last_modified):
+    """
+    Return True if the Range header should be honoured given If-Range
+    """
+    value = request.META.get('HTTP_IF_RANGE')
+    if not value:
+        return True
+    if value.startswith('"') or value.startswith('W/'):
+        return value == etag
+    return parse_http_date_safe(value) == last_modified
+
+def sendfile_response(path):
+    """
+    Return an empty response telling the proxy to send path, or None if no
+    sendfile backend is configured
+    """
+    backend = getattr(settings, 'PATCHES_SENDFILE', None)
+    if not backend:
+        return None
+
+    response = HttpResponse()
+    if backend == 'x-accel-redirect':
+        relative = os.path.relpath(path, settings.MEDIA_ROOT)
+        prefix = getattr(settings, 'PATCHES_SENDFILE_URL', '/protected-media/')
+        response['X-Accel-Redirect'] = quote(prefix.rstrip('/')+'/'+relative)
+    elif backend == 'x-sendfile':
+        response['X-Sendfile'] = path
+    else:
+        raise ValueError(f'Unknown PATCHES_SENDFILE backend {backend}')
+    #Let the proxy fill in the type from the file
+    del response['Content-Type']
+    return response
+
+def serve_file(request, field_file, checksum=None, filename=None, as_attachment=False):
+    """
+    Return a response for the stored file field_file. The ETag is the
+    checksum if there is one, otherwise the size and modification time.
+    Single byte ranges are supported, with If-Range.
+    """
+    path = field_file.path
+    stat = os.stat(path)
+    size = stat.st_size
+    last_modified = int(stat.st_mtime)
+    if checksum:
+        etag = quote_etag(checksum)
+    else:
+        etag = quote_etag(f'{size:x}-{last_modified:x}')
+    if filename is None:
+        filename = os.path.basename(field_file.name)
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        return response
+
+    response = sendfile_response(path)
+    if response is None:
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        requested = None
+        header = request.META.get('HTTP_RANGE')
+        if header and if_range_matches(request, etag, last_modified):
+            requested = parse_range(header, size)
+
+        if requested is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+
+        fp = open(path, 'rb')
+        if requested is None:
+            response = FileResponse(fp, content_type=content_type)
+        else:
+            start, end = requested
+            length = end-start+1
+            fp.seek(start)
+            if end == size-1:
+                #Running to the end of the file, so the file itself can be
+                #handed to wsgi.file_wrapper for sendfile
+                response = FileResponse(fp, content_type=content_type, status=206)
+            else:
+                response = FileResponse(RangeFile(fp, length), content_type=content_type, status=206)
+            response['Content-Length'] = length
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+
+    disposition = 'attachment' if as_attachment else 'inline'
+    response['Content-Disposition'] = f"{disposition}; filename*=utf-8''{quote(filename)}"
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    return response
@@ -0,0 +1,45 @@
+import os
+import mimetypes
+
+from django.core.management.base import BaseCommand
+
+from patches.models import PatchEntry
+from patches.utils import generate_checksums
+
+
+class Command(BaseCommand):
+    help = 'Fill in the checksum, basename, size and type of recordings saved before they were stored'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+            help='Number of entries written per bulk_update')
+
+    def handle(self, *args, **options):
+        fields = ['recording_checksum', 'recording_basename', 'recording_size', 'recording_mime']
+        q = PatchEntry.objects.filter(
+            recording_checksum=None) | PatchEntry.objects.filter(
+            recording_basename=None) | PatchEntry.objects.filter(
+            recording_size=None)
+        q = q.order_by('id').only('id', 'recording', *fields)
+
+        entries = []
+        failed = 0
+        for entry in q.iterator():
+            try:
+                if not entry.recording_checksum:
+                    entry.recording_checksum = generate_checksums(entry.recording)['md5']
+                    entry.recording.close()
+                if entry.recording_size is None:
+                    entry.recording_size = entry.recording.size
+            except OSError as e:
+                failed += 1
+                self.stderr.write(f'Failed to read {entry.recording.name}: {e}')
+                continue
+            if not entry.recording_basename:
+                entry.recording_basename = os.path.basename(entry.recording.name)
+            if not entry.recording_mime:
+                entry.recording_mime = mimetypes.guess_type(entry.recording_basename)[0]
+            entries.append(entry)
+
+        PatchEntry.objects.bulk_update(entries, fields, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Backfilled {len(entries)} recordings, {failed} failed'))
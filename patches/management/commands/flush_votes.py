@@ -0,0 +1,51 @@
+import time
+import signal
+
+from django.core.management.base import BaseCommand
+
+from patches import votebuffer, ranking
+
+
+class Command(BaseCommand):
+    help = 'Apply comparison votes buffered by CompareView to the database'
+
+    refit_iterations = 20
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+            help='Flush the buffer once and exit instead of running continuously')
+        parser.add_argument('--batch-size', type=int, default=None,
+            help='Number of votes written per transaction')
+        parser.add_argument('--interval', type=float, default=None,
+            help='Seconds to wait between flushes')
+
+    def handle(self, *args, **options):
+        config = votebuffer.get_config()
+        batch_size = options['batch_size'] or config['BATCH_SIZE']
+        interval = options['interval'] or config['FLUSH_INTERVAL']
+
+        if options['once']:
+            self.flush(batch_size)
+            return
+
+        self.stopping = False
+        def stop(signum, frame):
+            self.stopping = True
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        while not self.stopping:
+            self.flush(batch_size)
+            deadline = time.monotonic() + interval
+            while not self.stopping and time.monotonic() < deadline:
+                time.sleep(0.1)
+
+        #Pick up anything written since the last flush before exiting
+        self.flush(batch_size)
+
+    def flush(self, batch_size):
+        applied = votebuffer.flush(batch_size)
+        if applied:
+            self.stdout.write(f'Applied {applied} votes')
+            #Short warm-started refit to fold the new votes into the ratings
+            ranking.refresh_ratings(warm_start=True, max_iter=self.refit_iterations)
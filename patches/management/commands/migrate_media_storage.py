@@ -0,0 +1,107 @@
+import os
+import re
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from patches.models import PatchImages, PatchAttachments, PatchEntry, StoredFile, shard_name
+from patches.utils import generate_checksums
+
+
+class Command(BaseCommand):
+    help = 'Move images, attachments and recordings into the sharded content-addressed layout'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+            help='Print the moves without making them')
+
+    def move(self, old, new, register=True):
+        """
+        Move the file old to new inside MEDIA_ROOT. Content-addressed names
+        hold identical content, so if new already exists old is just removed.
+        Return True if rows pointing at old should now point at new.
+        """
+        src = os.path.join(settings.MEDIA_ROOT, old)
+        dst = os.path.join(settings.MEDIA_ROOT, new)
+        if old == new:
+            if register and os.path.exists(dst):
+                StoredFile.register(new, os.path.getsize(dst))
+            return False
+
+        if self.dry_run:
+            self.stdout.write(f'{old} -> {new}')
+            return False
+
+        if os.path.exists(dst):
+            if os.path.exists(src):
+                os.remove(src)
+        elif os.path.exists(src):
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            os.rename(src, dst)
+        else:
+            self.stderr.write(f'Missing file {old}')
+            return False
+
+        if register:
+            StoredFile.register(new, os.path.getsize(dst))
+        return True
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+
+        moved = 0
+        for image in PatchImages.objects.order_by('id').iterator():
+            old = image.image.name
+            checksums = {'md5': image.checksum, 'blake2b': image.blake2b}
+            if not image.checksum or not image.blake2b:
+                checksums = generate_checksums(image.image)
+                image.image.close()
+            new = shard_name(PatchImages._meta.get_field('image').upload_to, checksums['md5'], old)
+            if self.move(old, new):
+                #Thumbnails are keyed on the source name, see warm_thumbnails
+                PatchImages.objects.filter(pk=image.pk).update(image=new, thumbnail_urls={},
+                    checksum=checksums['md5'], blake2b=checksums['blake2b'])
+                PatchEntry.bump_versions(image.patchentry_set.values_list('id', flat=True))
+                moved += 1
+
+        for attachment in PatchAttachments.objects.order_by('id').iterator():
+            old = attachment.file.name
+            checksums = {'md5': attachment.checksum, 'blake2b': attachment.blake2b}
+            if not attachment.checksum or not attachment.blake2b:
+                checksums = generate_checksums(attachment.file)
+                attachment.file.close()
+            original_name = attachment.original_name
+            if not original_name:
+                #Unsharded names are {basename}_{checksum}{ext}
+                basename, ext = os.path.splitext(os.path.basename(old))
+                original_name = re.sub(f'_{checksums["md5"]}$', '', basename)+ext
+            new = shard_name(PatchAttachments._meta.get_field('file').upload_to, checksums['md5'], old)
+            if self.move(old, new):
+                PatchAttachments.objects.filter(pk=attachment.pk).update(file=new,
+                    original_name=original_name, checksum=checksums['md5'], blake2b=checksums['blake2b'])
+                PatchEntry.bump_versions(attachment.patchentry_set.values_list('id', flat=True))
+                moved += 1
+
+        for entry in PatchEntry.objects.order_by('id').only('recording', 'peaks',
+                'recording_checksum', 'recording_basename').iterator():
+            old = entry.recording.name
+            checksum = entry.recording_checksum
+            if not checksum:
+                checksum = generate_checksums(entry.recording)['md5']
+                entry.recording.close()
+            new = shard_name(PatchEntry._meta.get_field('recording').upload_to, checksum, old)
+            if not self.move(old, new):
+                continue
+            update = {
+                'recording': new,
+                'recording_checksum': checksum,
+                'recording_basename': entry.recording_basename or os.path.basename(old),
+                }
+            if entry.peaks.name == f'{old}.peaks' and self.move(entry.peaks.name, f'{new}.peaks', register=False):
+                update['peaks'] = f'{new}.peaks'
+            PatchEntry.objects.filter(pk=entry.pk).update(**update)
+            moved += 1
+
+        self.stdout.write(self.style.SUCCESS(f'Moved {moved} files'))
+        if moved:
+            self.stdout.write('Run warm_thumbnails to regenerate the thumbnails of moved images')
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from django.db.models import OuterRef, Subquery
+
+from patches.models import PatchEntry, AudioMetadata
+from patches import caching
+
+
+class Command(BaseCommand):
+    help = 'Copy AudioMetadata.duration onto PatchEntry.duration for every entry'
+
+    def handle(self, *args, **options):
+        durations = AudioMetadata.objects.filter(pk=OuterRef('meta_id')).values('duration')
+        updated = PatchEntry.objects.update(duration=Subquery(durations))
+        caching.bump_generation('entries')
+        self.stdout.write(self.style.SUCCESS(f'Refreshed durations for {updated} entries'))
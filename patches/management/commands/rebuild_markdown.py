@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from patches.models import PatchEntry, PatchTag
+from patches import caching
+from tttweb.templatetags.tttcms_tags import render_markdown
+
+
+class Command(BaseCommand):
+    help = 'Re-render the stored markdown html of every entry and tag'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+            help='Number of rows written per bulk_update')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        tags = list(PatchTag.objects.only('id', 'description'))
+        for tag in tags:
+            tag.render_html()
+        with transaction.atomic():
+            PatchTag.objects.bulk_update(tags, ['description_html', 'summary_html'], batch_size=batch_size)
+
+        entries = []
+        count = 0
+        for entry in PatchEntry.objects.only('id', 'desc').iterator():
+            entry.desc_html = render_markdown(entry.desc)
+            entries.append(entry)
+            if len(entries) >= batch_size:
+                count += self.write(entries)
+                entries = []
+        count += self.write(entries)
+
+        caching.bump_generation('entries')
+        self.stdout.write(self.style.SUCCESS(f'Rendered markdown for {len(tags)} tags and {count} entries'))
+
+    def write(self, entries):
+        #bulk_update skips save(), bump the versions the cards are cached under
+        with transaction.atomic():
+            PatchEntry.objects.bulk_update(entries, ['desc_html'])
+            PatchEntry.bump_versions(x.pk for x in entries)
+        return len(entries)
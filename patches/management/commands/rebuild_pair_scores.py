@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from patches.models import BinaryQuestion, BinaryResponseDetail, PairScore
+
+
+class Command(BaseCommand):
+    help = 'Regenerate the PairScore table from BinaryResponseDetail'
+
+    def handle(self, *args, **options):
+        questions = BinaryQuestion.objects.in_bulk()
+
+        rows = BinaryResponseDetail.objects.values(
+            'answer__question_id',
+            'answer__entryA_id',
+            'answer__entryB_id',
+            'selected_a',
+            ).annotate(n=Count('id')).order_by()
+
+        totals = {}
+        for row in rows:
+            question = questions[row['answer__question_id']]
+            count_a = row['n'] if row['selected_a'] else 0
+            count_b = 0 if row['selected_a'] else row['n']
+            low, high, count_a, count_b = PairScore.get_key(question,
+                row['answer__entryA_id'], row['answer__entryB_id'], count_a, count_b)
+            counts = totals.setdefault((question.id, low, high), [0, 0])
+            counts[0] += count_a
+            counts[1] += count_b
+
+        scores = []
+        for (question_id, low, high), (count_a, count_b) in totals.items():
+            scores.append(PairScore(
+                question_id = question_id,
+                entry_low_id = low,
+                entry_high_id = high,
+                count_a = count_a,
+                count_b = count_b,
+                score = count_a/(count_a+count_b),
+                ))
+
+        with transaction.atomic():
+            PairScore.objects.all().delete()
+            PairScore.objects.bulk_create(scores, batch_size=1000)
+
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {len(scores)} pair scores'))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from patches.models import PatchEntry
+
+
+class Command(BaseCommand):
+    help = 'Generate waveform peaks files for recordings that are missing them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ids', type=int, nargs='+', default=None,
+            help='Only process the entries with these ids')
+        parser.add_argument('--force', action='store_true',
+            help='Regenerate peaks even if they are up to date')
+
+    def handle(self, *args, **options):
+        q = PatchEntry.objects.order_by('id')
+        if options['ids']:
+            q = q.filter(id__in=options['ids'])
+
+        generated = 0
+        for entry in q.iterator():
+            if not options['force'] and entry.peaks.name == entry.get_peaks_name():
+                continue
+            try:
+                entry.refresh_peaks()
+            except Exception as e:
+                self.stderr.write(f'Failed to generate peaks for {entry.recording.name}: {e}')
+                continue
+            PatchEntry.objects.filter(pk=entry.pk).update(peaks=entry.peaks.name)
+            generated += 1
+
+        self.stdout.write(self.style.SUCCESS(f'Generated peaks for {generated} recordings'))
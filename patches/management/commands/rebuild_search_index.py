@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from patches.models import PatchEntry
+from patches import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index for every entry'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+            help='Number of entries indexed at once')
+
+    def handle(self, *args, **options):
+        backend = search.get_backend()
+        if isinstance(backend, search.MySQLBackend) and backend.ensure_index():
+            self.stdout.write('Created the FULLTEXT index')
+
+        ids = list(PatchEntry.objects.order_by('id').values_list('id', flat=True))
+        batch_size = options['batch_size']
+        start = time.monotonic()
+        for i in range(0, len(ids), batch_size):
+            search.index_entries(ids[i:i+batch_size])
+            done = min(i+batch_size, len(ids))
+            self.stdout.write(f'{done}/{len(ids)} entries, {done/(time.monotonic()-start):.1f} entries/s')
+
+        self.stdout.write(self.style.SUCCESS(f'Indexed {len(ids)} entries'))
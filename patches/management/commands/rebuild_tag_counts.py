@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from django.db.models.functions import Lower
+
+from patches.models import PatchTag
+from patches import caching
+
+
+class Command(BaseCommand):
+    help = 'Recompute the denormalized PatchTag.entry_count and lower_name for every tag'
+
+    def handle(self, *args, **options):
+        PatchTag.objects.update(lower_name=Lower('name'))
+        updated = PatchTag.refresh_counts()
+        caching.bump_generation('entries')
+        self.stdout.write(self.style.SUCCESS(f'Refreshed entry counts for {updated} tags'))
@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from patches import ranking
+from patches.models import BinaryQuestion
+
+
+class Command(BaseCommand):
+    help = 'Fit Bradley-Terry ratings for entries from the rating question answers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--question', default=None,
+            help='Slug of the question to rank by, defaults to PATCHES_RATING_QUESTION')
+        parser.add_argument('--full', action='store_true',
+            help='Fit from scratch instead of warm-starting from the stored ratings')
+        parser.add_argument('--max-iter', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if options['question']:
+            question = BinaryQuestion.objects.filter(slug=options['question']).order_by('id').first()
+        else:
+            question = ranking.get_rating_question()
+        if question is None:
+            raise CommandError('No rating question found')
+        if not question.slug in BinaryQuestion.merge_methods['reversed']:
+            raise CommandError(f'Question {question.slug} can not be used for ranking')
+
+        start = time.monotonic()
+        rated = ranking.rank_question(question,
+            warm_start = not options['full'],
+            max_iter = options['max_iter'],
+            )
+        elapsed = time.monotonic()-start
+        self.stdout.write(self.style.SUCCESS(f'Rated {rated} entries in {elapsed:.2f}s'))
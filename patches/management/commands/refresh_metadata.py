@@ -0,0 +1,158 @@
+import os
+import mimetypes
+import time
+import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import audio_metadata as audiometa
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+
+from patches.models import PatchEntry, AudioMetadata
+from patches import caching
+
+
+def read_metadata(path):
+    """
+    Read the duration of the recording at path. Runs in a worker process.
+    Return (duration in seconds, size, mtime)
+    """
+    stat = os.stat(path)
+    metadata = audiometa.load(path)
+    return metadata['streaminfo']['duration'], stat.st_size, stat.st_mtime
+
+
+class Command(BaseCommand):
+    help = 'Re-read AudioMetadata for recordings that changed since the last run, in parallel'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ids', type=int, nargs='+', default=None,
+            help='Only refresh the entries with these ids')
+        parser.add_argument('--author', action='append', default=[],
+            help='Only refresh entries by this author display name, may be repeated')
+        parser.add_argument('--tag', action='append', default=[],
+            help='Only refresh entries with this tag, may be repeated')
+        parser.add_argument('--force', action='store_true',
+            help='Refresh every selected entry even if its file is unchanged')
+        parser.add_argument('--workers', type=int, default=None,
+            help='Number of worker processes, defaults to the number of CPUs')
+        parser.add_argument('--batch-size', type=int, default=500,
+            help='Number of results written per bulk_update')
+
+    def get_queryset(self, options):
+        q = PatchEntry.objects.select_related('meta').order_by('id')
+        if options['ids']:
+            q = q.filter(id__in=options['ids'])
+        if options['author']:
+            q = q.filter(authors__display_name__in=options['author'])
+        if options['tag']:
+            #Case-insensitive like the index and API tag filters
+            q = q.filter(tags__lower_name__in=[x.lower() for x in options['tag']])
+        return q.distinct()
+
+    def handle(self, *args, **options):
+        #path: entries, recordings are content addressed so entries can share one
+        pending = {}
+        filled = []
+        skipped = 0
+        missing = 0
+        for entry in self.get_queryset(options).iterator():
+            path = entry.recording.path
+            try:
+                stat = os.stat(path)
+            except OSError:
+                missing += 1
+                continue
+            if entry.meta and not options['force'] and entry.meta.is_current(stat):
+                skipped += 1
+                if self.set_recording_info(entry, stat.st_size):
+                    filled.append(entry)
+                continue
+            pending.setdefault(path, []).append(entry)
+
+        #Backfill the enclosure info of unchanged recordings, it only needs the stat
+        with transaction.atomic():
+            PatchEntry.objects.bulk_update(filled, ['recording_size', 'recording_mime'], batch_size=options['batch_size'])
+            PatchEntry.bump_versions(x.pk for x in filled)
+        if filled:
+            caching.bump_generation('entries')
+
+        total = len(pending)
+        self.stdout.write(f'{total} recordings to read, {skipped} unchanged, {missing} missing')
+        if total == 0:
+            return
+
+        #Worker processes must not inherit open database connections
+        connections.close_all()
+
+        self.results = []
+        self.written = 0
+        done = 0
+        failed = 0
+        start = time.monotonic()
+        with ProcessPoolExecutor(max_workers=options['workers']) as pool:
+            futures = {pool.submit(read_metadata, path): entries for path, entries in pending.items()}
+            for future in as_completed(futures):
+                entries = futures[future]
+                done += 1
+                try:
+                    result = future.result()
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f'Failed to read {entries[0].recording.name}: {e}')
+                else:
+                    self.results.extend((entry, result) for entry in entries)
+
+                if len(self.results) >= options['batch_size']:
+                    self.write_results()
+
+                if done % 100 == 0 or done == total:
+                    elapsed = time.monotonic()-start
+                    self.stdout.write(f'{done}/{total} read, {done/elapsed:.1f} files/s')
+
+        self.write_results()
+        elapsed = time.monotonic()-start
+        self.stdout.write(self.style.SUCCESS(
+            f'Refreshed {self.written} entries in {elapsed:.1f}s, {failed} recordings failed'))
+
+    def set_recording_info(self, entry, size):
+        """
+        Store the recording's size and type on entry. Return True if they
+        changed.
+        """
+        mime = mimetypes.guess_type(entry.recording_basename or entry.recording.name)[0]
+        if entry.recording_size == size and entry.recording_mime == mime:
+            return False
+        entry.recording_size = size
+        entry.recording_mime = mime
+        return True
+
+    def write_results(self):
+        """
+        Save the accumulated results with bulk_update
+        """
+        metas = []
+        entries = []
+        with transaction.atomic():
+            for entry, (duration, size, mtime) in self.results:
+                duration = datetime.timedelta(seconds=duration)
+                if entry.meta is None:
+                    entry.meta = AudioMetadata.objects.create(
+                        duration=duration, file_size=size, file_mtime=mtime)
+                else:
+                    entry.meta.duration = duration
+                    entry.meta.file_size = size
+                    entry.meta.file_mtime = mtime
+                    metas.append(entry.meta)
+                entry.duration = duration
+                self.set_recording_info(entry, size)
+                entries.append(entry)
+
+            AudioMetadata.objects.bulk_update(metas, ['duration', 'file_size', 'file_mtime'])
+            PatchEntry.objects.bulk_update(entries, ['meta', 'duration', 'recording_size', 'recording_mime'])
+            PatchEntry.bump_versions(x.pk for x in entries)
+
+        if entries:
+            caching.bump_generation('entries')
+        self.written += len(entries)
+        self.results = []
@@ -0,0 +1,50 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from patches import thumbnails
+from patches.models import PatchImages
+
+
+def warm(image):
+    try:
+        return thumbnails.generate_thumbnails(image)
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = 'Generate every aliased thumbnail for the image library in parallel'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4,
+            help='Number of images to process at once')
+        parser.add_argument('--force', action='store_true',
+            help='Regenerate thumbnails for images that already have stored urls')
+
+    def handle(self, *args, **options):
+        q = PatchImages.objects.order_by('id')
+        if not options['force']:
+            q = q.filter(thumbnail_urls={})
+        images = list(q)
+        total = len(images)
+
+        done = 0
+        failed = 0
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            futures = {pool.submit(warm, image): image for image in images}
+            for future in as_completed(futures):
+                done += 1
+                try:
+                    future.result()
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f'Failed to generate thumbnails for {futures[future]}: {e}')
+                if done % 100 == 0 or done == total:
+                    elapsed = time.monotonic()-start
+                    self.stdout.write(f'{done}/{total} images, {done/elapsed:.1f} images/s')
+
+        self.stdout.write(self.style.SUCCESS(f'Warmed thumbnails for {done-failed} images, {failed} failed'))
@@ -1,20 +1,34 @@
-from django.db import models
+from django.db import models, connection, transaction, IntegrityError
 import os
 import hashlib
 import random
 import datetime
+import logging
+import uuid
+import mimetypes
 
 from django.urls import reverse
+from django.utils import timezone
+from django.db.models.functions import Coalesce, Cast
 
 from django.contrib.auth.models import User
 
+from django.core.files.base import ContentFile, File
 from django.core.files.storage import FileSystemStorage
+from django.db.models.fields.files import FieldFile
+from django.core.cache import cache
 
 from easy_thumbnails.fields import ThumbnailerImageField
+from easy_thumbnails.files import get_thumbnailer
 
 from licensing.models import Licensed
+from tttweb.templatetags.tttcms_tags import render_markdown
 
-from .utils import generate_checksum
+from .utils import generate_checksums
+from . import waveform
+from . import thumbnails
+
+logger = logging.getLogger(__name__)
 
 # Create your models here.
 
@@ -56,17 +70,50 @@ class PatchTag(models.Model):
     """
 #    entry = models.ForeignKey(PatchEntry, on_delete=models.CASCADE, related_name='tags')
     name = CaseTextField(max_length = 512, unique=True)
+    #Lowercased copy of name, so case-insensitive lookups can use an index
+    lower_name = models.CharField(max_length=512, default='', db_index=True, editable=False)
     description = models.TextField()
+    entry_count = models.IntegerField(default=0, db_index=True)
+    #Rendered markdown, see render_html
+    description_html = models.TextField(null=True, blank=True, editable=False)
+    summary_html = models.TextField(null=True, blank=True, editable=False)
 
     def summary(self):
         return self.description.split('\n')[0]
 
+    def render_html(self):
+        self.description_html = render_markdown(self.description)
+        self.summary_html = render_markdown(self.summary())
+
+    def save(self, *args, **kwargs):
+        self.render_html()
+        self.lower_name = self.name.lower()
+        super(PatchTag, self).save(*args, **kwargs)
+
     def count(self):
         """
         Return the number of PatchEntries having this tag
         """
         return PatchEntry.objects.filter(tags__name=self.name).count()
 
+    @classmethod
+    def refresh_counts(cls, tag_ids=None):
+        """
+        Recompute entry_count from the PatchEntry.tags through table in a
+        single UPDATE. If tag_ids is given, only refresh those tags.
+        """
+        through = PatchEntry.tags.through
+        counts = through.objects.filter(
+            patchtag_id=models.OuterRef('pk')
+            ).order_by().values('patchtag_id').annotate(
+                n=models.Count('patchentry_id')
+            ).values('n')
+
+        q = cls.objects.all()
+        if tag_ids is not None:
+            q = q.filter(id__in=tag_ids)
+        return q.update(entry_count=Coalesce(models.Subquery(counts), 0))
+
     def __str__(self):
         return self.name
 
@@ -75,6 +122,9 @@ import audio_metadata as audiometa
 class AudioMetadata(models.Model):
 
     duration = models.DurationField()
+    #Size and modification time of the recording when it was last read
+    file_size = models.BigIntegerField(null=True, blank=True)
+    file_mtime = models.FloatField(null=True, blank=True)
 
     @classmethod
     def create(cls, recording):
@@ -83,33 +133,106 @@ class AudioMetadata(models.Model):
         return result
 
     def refresh(self, recording, loud=False):
+        stat = os.stat(recording.path)
         metadata = audiometa.load(recording.path)
         self.duration = datetime.timedelta(seconds=metadata['streaminfo']['duration'])
+        self.file_size = stat.st_size
+        self.file_mtime = stat.st_mtime
         if loud:
             print(f'New duration: {self.duration}')
 
+    def is_current(self, stat):
+        """
+        Return True if this was read from a file matching the given os.stat
+        """
+        return self.file_size == stat.st_size and self.file_mtime == stat.st_mtime
+
 
     def __str__(self):
         return f'Duration: {self.duration}'
 
-class UniqueFileStorage(FileSystemStorage):
+class StoredFile(models.Model):
+    """
+    Index of the files in ShardedStorage, so that content that is already
+    stored can be found without touching the filesystem
+    """
+    name = models.CharField(max_length=255, unique=True)
+    checksum = models.CharField(max_length=36, db_index=True)
+    size = models.BigIntegerField(null=True)
+
+    @classmethod
+    def register(cls, name, size=None):
+        #Sharded names are the checksum of the content
+        checksum = os.path.splitext(os.path.basename(name))[0]
+        obj, _ = cls.objects.get_or_create(name=name, defaults={'checksum': checksum, 'size': size})
+        return obj
+
+    def __str__(self):
+        return self.name
+
+def shard_name(prefix, checksum, filename):
+    """
+    Return the content-addressed name prefix/ab/cd/<checksum><ext>
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    return os.path.join(prefix, checksum[:2], checksum[2:4], f'{checksum}{ext}')
+
+class ShardedStorage(FileSystemStorage):
+    """
+    Content-addressed storage. Files are saved under the directory given by
+    upload_to as ab/cd/<md5><ext>, see shard_name. A name only ever holds
+    the same content, so a name in the StoredFile index is reused without
+    touching the filesystem and a new one is written atomically over
+    whatever is there.
+    """
+    def save(self, name, content, max_length=None):
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        checksum = generate_checksums(content)['md5']
+        name = shard_name(os.path.dirname(name), checksum, name)
+        return super(ShardedStorage, self).save(name, content, max_length=max_length)
+
     def get_available_name(self, name, max_length=None):
         if max_length and len(name) > max_length:
             raise(Exception("name's length is greater than max_length"))
         return name
 
     def _save(self, name, content):
-        if self.exists(name):
-            # if the file exists, do not call the superclasses _save method
+        if StoredFile.objects.filter(name=name).exists():
             return name
-        # if the file is new, DO call it
-        return super(UniqueFileStorage, self)._save(name, content)
+        #Write under a unique name first so concurrent saves of the same
+        #content can't collide, then move it into place
+        part = super(ShardedStorage, self)._save(f'{name}.{uuid.uuid4().hex}.part', content)
+        os.replace(self.path(part), self.path(name))
+        StoredFile.register(name, content.size)
+        return name
+
+    def delete(self, name):
+        super(ShardedStorage, self).delete(name)
+        StoredFile.objects.filter(name=name).delete()
 
 
-def unique_file_name(instance, filename):
-    checksum = instance.checksum
-    basename, ext = os.path.splitext(filename)
-    return os.path.join(instance.unique_filepath, f'{basename}_{checksum}{ext}')
+class OriginalNameFieldFile(FieldFile):
+    """
+    FieldFile noting the name a file is saved under on its instance, in
+    original_names, before ShardedStorage replaces it with a checksum. This
+    survives FieldFile.save(..., save=False) followed by a later save() of
+    the instance.
+    """
+    def save(self, name, content, save=True):
+        original_names = self.instance.__dict__.setdefault('original_names', {})
+        original_names[self.field.name] = os.path.basename(name)
+        super().save(name, content, save)
+
+class OriginalNameFileField(models.FileField):
+    attr_class = OriginalNameFieldFile
+
+def pop_original_name(instance, field_name):
+    """
+    Return the name the file in field_name was last saved under, if it was
+    saved since the instance was, see OriginalNameFieldFile
+    """
+    return instance.__dict__.get('original_names', {}).pop(field_name, None)
 
 
 class PatchImages(models.Model):
@@ -117,15 +240,39 @@ class PatchImages(models.Model):
     Images attached to an entry, 1 or more
     """
 #    entry = models.ForeignKey(PatchEntry, on_delete=models.CASCADE, related_name='images')
-#    image = models.ImageField(upload_to=unique_file_name, storage=UniqueFileStorage)
-    image = ThumbnailerImageField(upload_to=unique_file_name, storage=UniqueFileStorage)
+    image = ThumbnailerImageField(upload_to='patches/images/', storage=ShardedStorage)
     checksum = models.CharField(max_length=36, unique=True, null=True)
-   
-    unique_filepath = 'patches/images'
+    blake2b = models.CharField(max_length=128, null=True, db_index=True)
+    #Thumbnail url for each THUMBNAIL_ALIASES alias, see thumbnails.py
+    thumbnail_urls = models.JSONField(default=dict, blank=True, editable=False)
 
     def save(self, *args, **kwargs):
-        self.checksum = generate_checksum(self.image.file)
+        checksums = None
+        if not self.image._committed:
+            #Only hash newly assigned files, uploads come with their digests
+            checksums = generate_checksums(self.image.file)
+        elif not self.checksum:
+            #Close the stored file again, long running commands save many
+            with self.image.open('rb') as fp:
+                checksums = generate_checksums(fp)
+        if checksums:
+            self.checksum = checksums['md5']
+            self.blake2b = checksums['blake2b']
         super(PatchImages, self).save(*args, **kwargs)
+        thumbnails.schedule(self)
+
+    def get_thumbnail_url(self, alias):
+        """
+        Return the stored url for the alias, generating the thumbnail if it
+        hasn't been stored yet
+        """
+        url = self.thumbnail_urls.get(alias, None)
+        if url:
+            return url
+        try:
+            return get_thumbnailer(self.image)[alias].url
+        except Exception:
+            return ''
 
     def __str__(self):
         return str(self.image)
@@ -137,36 +284,85 @@ class PatchAttachments(models.Model):
     """
     Generic files attached to an entry, 0 or more
     """
-    file = models.FileField(upload_to=unique_file_name, storage=UniqueFileStorage)
+    file = OriginalNameFileField(upload_to='patches/attachements/', storage=ShardedStorage)
     checksum = models.CharField(max_length=36, unique=True, null=True)
-
-    unique_filepath = 'patches/attachements/'
+    blake2b = models.CharField(max_length=128, null=True, db_index=True)
+    #Name the file was uploaded with, stored names are checksums
+    original_name = models.CharField(max_length=255, null=True, blank=True)
 
     def save(self, *args, **kwargs):
-        self.checksum = generate_checksum(self.file)
+        original_name = pop_original_name(self, 'file')
+        if original_name:
+            self.original_name = original_name
+        checksums = None
+        if not self.file._committed:
+            self.original_name = os.path.basename(self.file.name)
+            checksums = generate_checksums(self.file.file)
+        elif not self.checksum:
+            #Close the stored file again, long running commands save many
+            with self.file.open('rb') as fp:
+                checksums = generate_checksums(fp)
+        if checksums:
+            self.checksum = checksums['md5']
+            self.blake2b = checksums['blake2b']
         super(PatchAttachments, self).save(*args, **kwargs)
 
     def filename(self):
-        return os.path.basename(self.file.name)
+        return self.original_name or os.path.basename(self.file.name)
 
 
 class PatchEntry(Licensed):
     name = models.TextField()
-    recording = models.FileField(upload_to='patches/recordings/')
+    recording = OriginalNameFileField(upload_to='patches/recordings/', storage=ShardedStorage)
+    #md5 of the recording, which also names it in storage
+    recording_checksum = models.CharField(max_length=36, null=True, blank=True, db_index=True)
+    #Name the recording was uploaded with
+    recording_basename = models.CharField(max_length=255, null=True, blank=True, db_index=True)
+    #Size and type of the recording for feed enclosures
+    recording_size = models.BigIntegerField(null=True, blank=True)
+    recording_mime = models.CharField(max_length=100, null=True, blank=True)
+    #Waveform peaks file stored next to the recording, see waveform.py
+    peaks = models.FileField(null=True, blank=True, editable=False)
     meta = models.ForeignKey(AudioMetadata, null=True, on_delete=models.CASCADE, related_name='source')
+    #Copy of meta.duration so that length filters and sorts don't need a join
+    duration = models.DurationField(null=True)
+    #Bradley-Terry rating from the rating question, see ranking.py
+    rating = models.FloatField(null=True, blank=True)
     date = models.DateTimeField()
     desc = models.TextField(null=True, blank=True)
+    #Rendered markdown of desc
+    desc_html = models.TextField(null=True, blank=True, editable=False)
+    #Bumped whenever anything shown on the entry's card changes, see
+    #bump_versions and signals.py
+    version = models.PositiveIntegerField(default=0, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
     tags = models.ManyToManyField(PatchTag, blank=True)
     images = models.ManyToManyField(PatchImages, blank=True)
     authors = models.ManyToManyField(PatchAuthorName)
     attachments = models.ManyToManyField(PatchAttachments, blank=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['date', 'id']),
+            models.Index(fields=['duration', 'id']),
+            models.Index(fields=['rating', 'id']),
+            ]
+
     def __str__(self):
         try:
             return f'Audio File - {self.meta.duration} - {self.name}'
         except Exception as e:
             return f'Error rendering entry name: {e}'
 
+    @classmethod
+    def bump_versions(cls, ids):
+        """
+        Mark the entries with the given ids as changed
+        """
+        ids = list(ids)
+        if ids:
+            cls.objects.filter(id__in=ids).update(version=models.F('version')+1, updated_at=timezone.now())
+
     @classmethod
     def refresh_metadata(cls):
         q = cls.objects.all()
@@ -175,13 +371,60 @@ class PatchEntry(Licensed):
             entry.meta.save()
 
     def save(self, *args, **kwargs):
+        original_name = pop_original_name(self, 'recording')
+        if original_name:
+            #Saved to storage already, e.g. with recording.save(name, content, save=False)
+            self.recording_basename = original_name
+        if self.recording and not self.recording._committed:
+            self.recording_basename = os.path.basename(self.recording.name)
+            self.recording_checksum = generate_checksums(self.recording.file)['md5']
+            self.recording_size = self.recording.size
+            self.recording_mime = mimetypes.guess_type(self.recording.name)[0]
+        elif self.recording and not self.recording_checksum:
+            self.recording_checksum = generate_checksums(self.recording)['md5']
+            self.recording.close()
+        if self.recording and self.recording_size is None:
+            self.recording_size = self.recording.size
+        if self.recording and not self.recording_mime:
+            self.recording_mime = mimetypes.guess_type(self.recording_basename or self.recording.name)[0]
+        self.desc_html = render_markdown(self.desc)
+        if not self._state.adding:
+            #Increment in the database, this instance's version may be stale
+            self.version = models.F('version')+1
+        if self.meta != None:
+            self.duration = self.meta.duration
         super(PatchEntry, self).save(*args, **kwargs)
+        if isinstance(self.version, models.expressions.Combinable):
+            self.refresh_from_db(fields=['version'])
         #This comes after so that the file exists
         if self.meta == None:
             self.meta = AudioMetadata.create(self.recording)
             self.meta.save()
+            self.duration = self.meta.duration
             super(PatchEntry, self).save()
 
+        if self.recording and self.peaks.name != self.get_peaks_name():
+            try:
+                self.refresh_peaks()
+            except Exception as e:
+                logger.warning(f'Failed to generate peaks for {self.recording.name}: {e}')
+            else:
+                super(PatchEntry, self).save(update_fields=['peaks'])
+
+    def get_peaks_name(self):
+        return f'{self.recording.name}.peaks'
+
+    def refresh_peaks(self):
+        """
+        Decode the recording and store its waveform peaks next to it
+        """
+        data = waveform.generate_peaks(self.recording.path)
+        name = self.get_peaks_name()
+        storage = self.peaks.storage
+        if storage.exists(name):
+            storage.delete(name)
+        self.peaks.name = storage.save(name, ContentFile(data))
+
     def get_absolute_url(self):
         return reverse('patches:detail', kwargs={'pk': self.id})
 
@@ -207,10 +450,79 @@ class PatchRepoAttachment(models.Model):
 
         return self.filename
 
+##
+## Search Models
+##
+
+class SearchTerm(models.Model):
+    """
+    Inverted index of the words in an entry, see search.py
+    """
+    term = models.CharField(max_length=64, db_index=True)
+    entry = models.ForeignKey(PatchEntry, on_delete=models.CASCADE, related_name='search_terms')
+    weight = models.FloatField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['term', 'entry'], name='unique_search_term'),
+            ]
+
+    def __str__(self):
+        return f'{self.term} - {self.entry_id}'
+
+class SearchDocument(models.Model):
+    """
+    Searchable text of an entry for the MySQL FULLTEXT backend, see search.py
+    """
+    entry = models.OneToOneField(PatchEntry, on_delete=models.CASCADE, primary_key=True, related_name='search_document')
+    text = models.TextField()
+
+    def __str__(self):
+        return str(self.entry_id)
+
 ##
 ## Comparison Models
 ##
 
+def increment_or_create(model, lookup, **increments):
+    """
+    Add increments to the counter fields of the row of model matching lookup,
+    creating the row if it doesn't exist yet. lookup must cover a unique
+    constraint. The update happens in the database so concurrent callers
+    can't overwrite each other. Return the pk of the row.
+    """
+    if connection.vendor == 'mysql':
+        #INSERT ... ON DUPLICATE KEY UPDATE, with LAST_INSERT_ID(pk) so that
+        #lastrowid is the pk whether the row was inserted or updated
+        opts = model._meta
+        quote = connection.ops.quote_name
+        fields = [opts.get_field(x) for x in list(lookup.keys())+list(increments.keys())]
+        columns = ', '.join(quote(x.column) for x in fields)
+        values = list(lookup.values()) + list(increments.values())
+        pk = quote(opts.pk.column)
+        updates = ', '.join(
+            f'{quote(opts.get_field(x).column)} = {quote(opts.get_field(x).column)} + VALUES({quote(opts.get_field(x).column)})'
+            for x in increments.keys())
+        sql = (f'INSERT INTO {quote(opts.db_table)} ({columns}) VALUES ({", ".join(["%s"]*len(values))}) '
+               f'ON DUPLICATE KEY UPDATE {pk} = LAST_INSERT_ID({pk}), {updates}')
+        with connection.cursor() as cursor:
+            cursor.execute(sql, values)
+            return cursor.lastrowid
+
+    #Update first so the transaction starts by taking the write lock. SQLite
+    #fails a transaction that reads and then writes while another one is
+    #writing, instead of waiting for it.
+    rows = model.objects.filter(**lookup)
+    updates = {key: models.F(key) + value for key, value in increments.items()}
+    if not rows.update(**updates):
+        try:
+            with transaction.atomic():
+                return model.objects.create(**lookup, **increments).pk
+        except IntegrityError:
+            #Created in between
+            rows.update(**updates)
+    return rows.values_list('pk', flat=True).get()
+
 class BinaryQuestion(models.Model):
     """
     A question with two possible answers.
@@ -236,16 +548,79 @@ class BinaryQuestion(models.Model):
         'reversed' : ['better',],
         }
 
-    def get_options(self):
-        #TODO: if/else on question text to hardcode custom filters
-        #TODO: query patch entries to select two
-        if self.selection_method == 0: #any two at random
-            entries = PatchEntry.objects.all()
-            if entries.count() < 2: return None
+    #Number of pairs drawn each time a question's pool runs out
+    pool_size = 100
+
+    entry_ids_key = 'patches:entry_ids'
+
+    @classmethod
+    def get_entry_ids(cls):
+        """
+        Return the cached list of all PatchEntry ids
+        """
+        ids = cache.get(cls.entry_ids_key)
+        if ids is None:
+            ids = list(PatchEntry.objects.values_list('id', flat=True))
+            cache.set(cls.entry_ids_key, ids, None)
+        return ids
+
+    @classmethod
+    def clear_entry_ids(cls):
+        cache.delete(cls.entry_ids_key)
+
+    def get_pool_key(self):
+        return f'patches:compare_pool:{self.pk}'
+
+    def refill_pool(self, batch_size=None):
+        """
+        Draw a new batch of random pairs of entry ids for this question and
+        store it as the question's pool
+        """
+        if batch_size is None:
+            batch_size = self.pool_size
+        ids = self.get_entry_ids()
+        if len(ids) < 2:
+            return []
 
-            return random.sample(list(entries), k=2)
+        if self.selection_method == 0: #any two at random
+            pairs = [random.sample(ids, k=2) for _ in range(batch_size)]
         else:
+            pairs = []
+
+        cache.set(self.get_pool_key(), pairs, None)
+        return pairs
+
+    def draw_pair(self):
+        """
+        Pop a pair of entry ids from this question's pool, refilling it if
+        empty. Return None if no pair can be drawn.
+        """
+        key = self.get_pool_key()
+        pairs = cache.get(key)
+        if not pairs:
+            pairs = self.refill_pool()
+        if not pairs:
             return None
+        pair = pairs.pop()
+        cache.set(key, pairs, None)
+        return pair
+
+    def get_options(self):
+        #TODO: if/else on question text to hardcode custom filters
+        for attempt in range(3):
+            pair = self.draw_pair()
+            if pair is None:
+                return None
+
+            entries = PatchEntry.objects.in_bulk(pair)
+            if len(entries) == 2:
+                return [entries[x] for x in pair]
+
+            #An entry has been deleted since the pool was drawn
+            self.clear_entry_ids()
+            cache.delete(self.get_pool_key())
+
+        return None
 
     def __str__(self):
         return str(self.question)
@@ -265,6 +640,72 @@ class BinaryAnswer(models.Model):
     count_a = models.IntegerField(default=0)
     count_b = models.IntegerField(default=0)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['entryA', 'entryB', 'question'], name='unique_binary_answer'),
+            ]
+
+    @classmethod
+    def record_vote(cls, question_id, entry_a_id, entry_b_id, selected_a, origin):
+        """
+        Record one response comparing entry_a to entry_b and return its
+        BinaryResponseDetail
+        """
+        return cls.record_votes([{
+            'question_id': question_id,
+            'entry_a_id': entry_a_id,
+            'entry_b_id': entry_b_id,
+            'selected_a': selected_a,
+            'origin': origin,
+            }])[0]
+
+    @classmethod
+    def record_votes(cls, votes):
+        """
+        Record a batch of responses. Each vote is a dictionary of
+        {
+        question_id, entry_a_id, entry_b_id, selected_a, origin, [date], [vote_id]
+        }
+        Counts are summed per answer before being written, and the answers,
+        response details and pair scores are all written in a single
+        transaction with database-side increments, so concurrent votes on
+        the same pair are never lost. Return the BinaryResponseDetails.
+        """
+        questions = BinaryQuestion.objects.in_bulk({int(x['question_id']) for x in votes})
+
+        counts = {}
+        for vote in votes:
+            key = (int(vote['question_id']), int(vote['entry_a_id']), int(vote['entry_b_id']))
+            if key[0] not in questions:
+                raise BinaryQuestion.DoesNotExist(f'No question with id {key[0]}')
+            count = counts.setdefault(key, [0, 0])
+            count[0 if vote['selected_a'] else 1] += 1
+
+        with transaction.atomic():
+            answer_ids = {}
+            for key, (count_a, count_b) in counts.items():
+                question_id, entry_a_id, entry_b_id = key
+                answer_ids[key] = increment_or_create(cls,
+                    {'entryA_id': entry_a_id, 'entryB_id': entry_b_id, 'question_id': question_id},
+                    count_a = count_a,
+                    count_b = count_b,
+                    )
+                PairScore.record(questions[question_id], entry_a_id, entry_b_id, count_a, count_b)
+
+            details = []
+            for vote in votes:
+                key = (int(vote['question_id']), int(vote['entry_a_id']), int(vote['entry_b_id']))
+                details.append(BinaryResponseDetail(
+                    answer_id = answer_ids[key],
+                    selected_a = vote['selected_a'],
+                    origin = vote['origin'],
+                    date = vote.get('date', None) or timezone.now(),
+                    vote_id = vote.get('vote_id', None),
+                    ))
+            BinaryResponseDetail.objects.bulk_create(details)
+
+        return details
+
     def align(self, entry):
         """
         Align self to the given entry so that it corresponds to entryA
@@ -345,11 +786,95 @@ class BinaryResponseDetail(models.Model):
     """
     answer = models.ForeignKey(BinaryAnswer, on_delete=models.PROTECT, related_name='responses')
     selected_a = models.BooleanField()
-    date = models.DateTimeField(auto_now_add=True)
+    date = models.DateTimeField(default=timezone.now, editable=False)
     origin = models.TextField() #This should be some kind of hash uniquely identifying an origin
+    #Id of the buffered vote this was recorded from, see votebuffer.py
+    vote_id = models.CharField(max_length=32, unique=True, null=True, blank=True, editable=False)
 
     def __str__(self):
         return f"""{self.answer}
     {self.answer.question.answer_a if self.selected_a else self.answer.question.answer_b} At: {self.date}
     From: {self.origin}"""
 
+
+class PairScore(models.Model):
+    """
+    The merged answer counts for an unordered pair of entries on a question,
+    i.e. a BinaryAnswer combined with its complement. entry_low is always the
+    entry with the lower id and the counts are aligned to it. Kept current as
+    votes are recorded so that the best matches for an entry can be read
+    with a single indexed query.
+    """
+    question = models.ForeignKey(BinaryQuestion, on_delete=models.CASCADE, related_name='pair_scores')
+    entry_low = models.ForeignKey(PatchEntry, on_delete=models.CASCADE, related_name='+')
+    entry_high = models.ForeignKey(PatchEntry, on_delete=models.CASCADE, related_name='+')
+    count_a = models.IntegerField(default=0)
+    count_b = models.IntegerField(default=0)
+    score = models.FloatField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['question', 'entry_low', 'entry_high'], name='unique_pair_score'),
+            ]
+        indexes = [
+            models.Index(fields=['question', 'entry_low', 'score']),
+            models.Index(fields=['question', 'entry_high', 'score']),
+            ]
+
+    @staticmethod
+    def get_key(question, entry_a_id, entry_b_id, count_a, count_b):
+        """
+        Return (entry_low_id, entry_high_id, count_a, count_b) for counts
+        given in the order entry_a, entry_b
+        """
+        entry_a_id = int(entry_a_id)
+        entry_b_id = int(entry_b_id)
+        if entry_a_id <= entry_b_id:
+            return entry_a_id, entry_b_id, count_a, count_b
+        if question.slug in BinaryQuestion.merge_methods['reversed']:
+            count_a, count_b = count_b, count_a
+        return entry_b_id, entry_a_id, count_a, count_b
+
+    @classmethod
+    def record(cls, question, entry_a_id, entry_b_id, count_a=0, count_b=0):
+        """
+        Add counts from an answer comparing entry_a to entry_b
+        """
+        low, high, count_a, count_b = cls.get_key(question, entry_a_id, entry_b_id, count_a, count_b)
+        with transaction.atomic():
+            pair_id = increment_or_create(cls,
+                {'question_id': question.id, 'entry_low_id': low, 'entry_high_id': high},
+                count_a = count_a,
+                count_b = count_b,
+                )
+            total = models.F('count_a') + models.F('count_b')
+            cls.objects.filter(pk=pair_id).update(
+                score = Cast('count_a', models.FloatField())/Cast(total, models.FloatField()),
+                )
+
+    def align(self, entry):
+        """
+        Return an unsaved BinaryAnswer holding the merged counts with entry
+        as entryA
+        """
+        result = {
+            'entryA': self.entry_low,
+            'entryB': self.entry_high,
+            'question': self.question,
+            'count_a': self.count_a,
+            'count_b': self.count_b,
+            }
+
+        if self.entry_high_id == entry.id:
+            result['entryA'] = self.entry_high
+            result['entryB'] = self.entry_low
+            if self.question.slug in BinaryQuestion.merge_methods['reversed']:
+                result['count_a'] = self.count_b
+                result['count_b'] = self.count_a
+        elif self.entry_low_id != entry.id:
+            raise KeyError(f'Entry {entry} not in pair {self}')
+
+        return BinaryAnswer(**result)
+
+    def __str__(self):
+        return f'{self.question}: {self.entry_low_id} / {self.entry_high_id} = {self.count_a} / {self.count_b}'
@@ -0,0 +1,253 @@
+"""
+Keyset pagination of entries.
+
+A page continues from the sort value and id of the last row of the page
+before it, with WHERE (field, id) < (value, id) instead of an OFFSET, so
+every page costs the same however deep it is. The position is passed
+around as an opaque cursor. Querysets not ordered by one of keyset_fields
+and then id fall back to page numbers.
+
+NULLs are treated as smaller than every value, as views.order_entries
+orders them, so keyset and page number modes list the same entries.
+
+Totals are approximate: each distinct set of filters is counted once per
+entries generation and the result is cached for count_timeout seconds,
+so listing a page never runs a full COUNT.
+"""
+import json
+import base64
+import datetime
+import functools
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db.models import Q, F
+from django.db.models.expressions import OrderBy
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param, remove_query_param
+
+from tttweb.templatetags.tttcms_tags import sorted_querystring
+from . import caching
+
+count_timeout = 60*10
+
+microsecond = datetime.timedelta(microseconds=1)
+
+#Fields entries can be paged by, with functions converting their non-NULL
+#values to and from JSON
+keyset_fields = {
+    'date': (lambda x: x.isoformat(), parse_datetime),
+    'duration': (lambda x: x//microsecond, lambda x: datetime.timedelta(microseconds=int(x))),
+    'rating': (float, float),
+    'search_rank': (float, float),
+    }
+
+class InvalidCursor(ValueError):
+    pass
+
+def encode_cursor(value, pk, reverse=False):
+    data = json.dumps([value, pk, reverse], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """
+    Return (value, pk, reverse) for cursor or raise InvalidCursor
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor+'='*(-len(cursor) % 4))
+        value, pk, reverse = json.loads(data)
+        return value, int(pk), bool(reverse)
+    except (ValueError, TypeError):
+        raise InvalidCursor(cursor)
+
+def get_keyset_ordering(q):
+    """
+    Return (field, descending) if q is ordered by a keyset field and then
+    by id in the same direction, otherwise None
+    """
+    ordering = list(q.query.order_by)
+    if len(ordering) != 2 or not isinstance(ordering[1], str):
+        return None
+    first, second = ordering
+    if isinstance(first, str):
+        descending = first.startswith('-')
+        field = first.lstrip('-')
+    elif isinstance(first, OrderBy) and isinstance(first.expression, F):
+        descending = first.descending
+        field = first.expression.name
+    else:
+        return None
+    if field not in keyset_fields or second != ('-id' if descending else 'id'):
+        return None
+    return field, descending
+
+def approximate_count(q, key=None):
+    """
+    Return the number of rows in q, cached for count_timeout under key.
+    Without a key q is counted every time.
+    """
+    if key is None:
+        return q.count()
+    count = cache.get(key)
+    if count is None:
+        count = q.count()
+        cache.set(key, count, count_timeout)
+    return count
+
+def get_count_key(request, kind, *ignored):
+    """
+    Return the key approximate_count caches the total listed by request
+    under, from its querystring without the pagination parameters in ignored
+    """
+    params = request.GET.copy()
+    for x in ignored:
+        params.pop(x, None)
+    return caching.make_key('count', kind, caching.get_generation('entries'), request.path,
+        sorted_querystring(params))
+
+class KeysetPage:
+    """
+    One page of a keyset paginated queryset. The cursors are None when there
+    is no next or previous page.
+    """
+    def __init__(self, object_list, next_cursor, previous_cursor, count):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.count = count
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+def get_after(field, value, pk, descending):
+    """
+    Return the filter for the rows after (value, pk) in the ordering on
+    field and then id, with NULL as the smallest value
+    """
+    if descending:
+        if value is None:
+            return Q(**{f'{field}__isnull': True, 'id__lt': pk})
+        return Q(**{f'{field}__lt': value}) | Q(**{field: value, 'id__lt': pk}) | Q(**{f'{field}__isnull': True})
+    if value is None:
+        return Q(**{f'{field}__isnull': True, 'id__gt': pk}) | Q(**{f'{field}__isnull': False})
+    return Q(**{f'{field}__gt': value}) | Q(**{field: value, 'id__gt': pk})
+
+def paginate_keyset(q, cursor, page_size, count_key=None):
+    """
+    Return the KeysetPage of q starting after cursor, or the first page if
+    cursor is None. q must have a keyset ordering, see get_keyset_ordering.
+    """
+    field, descending = get_keyset_ordering(q)
+    to_json, from_json = keyset_fields[field]
+    count = approximate_count(q, count_key)
+
+    reverse = False
+    if cursor is not None:
+        raw, pk, reverse = decode_cursor(cursor)
+        value = None
+        if raw is not None:
+            try:
+                value = from_json(raw)
+            except (ValueError, TypeError):
+                raise InvalidCursor(cursor)
+            if value is None:
+                raise InvalidCursor(cursor)
+        #Going back flips both the comparison and the ordering
+        q = q.filter(get_after(field, value, pk, descending != reverse))
+        if reverse:
+            q = q.reverse()
+
+    rows = list(q[:page_size+1])
+    more = len(rows) > page_size
+    rows = rows[:page_size]
+    if reverse:
+        rows.reverse()
+        has_next, has_previous = True, more
+    else:
+        has_next, has_previous = more, cursor is not None
+
+    def position(row):
+        value = getattr(row, field)
+        return None if value is None else to_json(value)
+
+    next_cursor = None
+    previous_cursor = None
+    if rows and has_next:
+        next_cursor = encode_cursor(position(rows[-1]), rows[-1].pk)
+    if rows and has_previous:
+        previous_cursor = encode_cursor(position(rows[0]), rows[0].pk, True)
+    return KeysetPage(rows, next_cursor, previous_cursor, count)
+
+class ApproximateCountPaginator(Paginator):
+    """
+    Page number paginator whose total comes from approximate_count
+    """
+    def __init__(self, object_list, per_page, count_key=None, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.count_key = count_key
+
+    @cached_property
+    def count(self):
+        return approximate_count(self.object_list, self.count_key)
+
+class EntryPagination(BasePagination):
+    """
+    API pagination using keyset pages when the queryset is ordered by a
+    keyset field and page numbers otherwise. The response has the same
+    count, next, previous and results keys either way.
+    """
+    cursor_query_param = 'cursor'
+    page_size = api_settings.PAGE_SIZE
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page = None
+        self.fallback = None
+
+        if get_keyset_ordering(queryset) is None:
+            self.fallback = PageNumberPagination()
+            self.fallback.django_paginator_class = functools.partial(ApproximateCountPaginator,
+                count_key=get_count_key(request, 'pages', self.fallback.page_query_param))
+            return self.fallback.paginate_queryset(queryset, request, view)
+
+        cursor = request.query_params.get(self.cursor_query_param) or None
+        count_key = get_count_key(request, 'keyset', self.cursor_query_param, 'page')
+        try:
+            self.page = paginate_keyset(queryset, cursor, self.page_size, count_key)
+        except InvalidCursor:
+            raise NotFound('Invalid cursor')
+        return self.page.object_list
+
+    def get_paginated_response(self, data):
+        if self.fallback is not None:
+            return self.fallback.get_paginated_response(data)
+        return Response(OrderedDict([
+            ('count', self.page.count),
+            ('next', self.get_link(self.page.next_cursor)),
+            ('previous', self.get_link(self.page.previous_cursor)),
+            ('results', data),
+            ]))
+
+    def get_link(self, cursor):
+        if cursor is None:
+            return None
+        url = remove_query_param(self.request.build_absolute_uri(), 'page')
+        return replace_query_param(url, self.cursor_query_param, cursor)
@@ -0,0 +1,200 @@
+"""
+Bradley-Terry ranking of entries from the answers to a "better"-style
+question, i.e. one whose slug is in BinaryQuestion.merge_methods['reversed'].
+
+For an answer comparing entryA to entryB, count_a is the number of times A
+was preferred to B and count_b the number of times B was preferred to A.
+Each entry i gets a strength p_i such that P(i beats j) = p_i/(p_i+p_j),
+fitted with the MM algorithm (Hunter 2004). Strengths are stored on
+PatchEntry.rating on an Elo-like scale: 1500 + 400*log10(p_i).
+
+Ratings are refit by flush_votes when votes are buffered, and otherwise
+in a background thread after a vote is recorded, at most once every
+PATCHES_RATING_REFIT_INTERVAL seconds (see schedule_refit). refit_ratings
+runs a full refit.
+"""
+import math
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.conf import settings
+from django.db import connection, transaction
+
+from .models import PatchEntry, BinaryAnswer, BinaryQuestion
+from . import caching
+
+#Elo scale for stored ratings
+base_rating = 1500
+rating_scale = 400/math.log(10)
+
+#Iterations of the warm-started refit after a vote
+refit_iterations = 20
+#Times of the last vote and of the start of the last refit, kept with the
+#generations so they aren't culled
+vote_time_key = 'patches:ratings:vote-time'
+refit_time_key = 'patches:ratings:refit-time'
+refit_lock = 'patches:ratings:refit'
+
+logger = logging.getLogger(__name__)
+
+executor = None
+
+def get_executor():
+    global executor
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ratings')
+    return executor
+
+def get_rating_question():
+    """
+    Return the question that defines PatchEntry.rating, or None
+    """
+    slug = getattr(settings, 'PATCHES_RATING_QUESTION', 'better')
+    return BinaryQuestion.objects.filter(slug=slug).order_by('id').first()
+
+def get_comparisons(question):
+    """
+    Return (ids, winners, losers, counts) where ids is the array of entry
+    ids that have been compared, and each comparison is given as indices
+    into ids with the number of times the winner beat the loser.
+    """
+    rows = np.array(list(BinaryAnswer.objects.filter(question=question).values_list(
+        'entryA_id', 'entryB_id', 'count_a', 'count_b')), dtype=np.int64).reshape(-1, 4)
+
+    ids, index = np.unique(rows[:,:2], return_inverse=True)
+    index = index.reshape(-1, 2)
+    winners = np.concatenate([index[:,0], index[:,1]])
+    losers = np.concatenate([index[:,1], index[:,0]])
+    counts = np.concatenate([rows[:,2], rows[:,3]])
+    keep = counts > 0
+
+    return ids, winners[keep], losers[keep], counts[keep]
+
+def fit(n, winners, losers, counts, initial=None, prior=1.0, max_iter=1000, tol=1e-6):
+    """
+    Fit Bradley-Terry strengths for n players and return them as an array
+    normalized to a geometric mean of 1.
+
+    Every player is given prior virtual wins and losses against a player of
+    strength 1, which keeps players who never won or never lost finite.
+    initial warm-starts the fit from previous strengths.
+    """
+    if initial is None:
+        strengths = np.ones(n)
+    else:
+        strengths = np.asarray(initial, dtype=float).copy()
+
+    wins = np.bincount(winners, weights=counts, minlength=n) + prior
+    counts = counts.astype(float)
+
+    for iteration in range(max_iter):
+        per_game = counts/(strengths[winners]+strengths[losers])
+        denom = np.bincount(winners, weights=per_game, minlength=n)
+        denom += np.bincount(losers, weights=per_game, minlength=n)
+        denom += 2*prior/(strengths+1)
+
+        new = wins/denom
+        new /= np.exp(np.mean(np.log(new)))
+
+        change = np.max(np.abs(np.log(new)-np.log(strengths))) if n else 0
+        strengths = new
+        if change < tol:
+            break
+
+    return strengths
+
+def rank_question(question, warm_start=True, max_iter=1000, tol=1e-6):
+    """
+    Refit the ratings of every entry compared under question and store them
+    on PatchEntry.rating. With warm_start the fit starts from the stored
+    ratings, so a refit after a few new votes converges in a few iterations.
+    Return the number of entries rated.
+    """
+    #Votes committed after this are left to the next refit, see is_refit_pending
+    caching.get_generation_cache().set(refit_time_key, time.time(), None)
+    ids, winners, losers, counts = get_comparisons(question)
+    if len(ids) == 0:
+        return 0
+
+    initial = None
+    if warm_start:
+        stored = dict(PatchEntry.objects.filter(id__in=ids.tolist()).values_list('id', 'rating'))
+        ratings = np.array([stored.get(x) if stored.get(x) is not None else base_rating
+            for x in ids.tolist()], dtype=float)
+        initial = np.exp((ratings-base_rating)/rating_scale)
+
+    strengths = fit(len(ids), winners, losers, counts, initial=initial, max_iter=max_iter, tol=tol)
+    ratings = base_rating + rating_scale*np.log(strengths)
+
+    entries = [PatchEntry(id=x, rating=y) for x, y in zip(ids.tolist(), ratings.tolist())]
+    with transaction.atomic():
+        PatchEntry.objects.bulk_update(entries, ['rating'], batch_size=1000)
+        PatchEntry.bump_versions(ids.tolist())
+    caching.bump_generation('entries')
+
+    return len(entries)
+
+def refresh_ratings(warm_start=True, max_iter=1000):
+    """
+    Refit PatchEntry.rating from the rating question if there is one
+    """
+    question = get_rating_question()
+    if question is None:
+        #Nothing to fit, the pending votes are dealt with all the same
+        caching.get_generation_cache().set(refit_time_key, time.time(), None)
+        return 0
+    return rank_question(question, warm_start=warm_start, max_iter=max_iter)
+
+def is_refit_pending():
+    """
+    Return True if a vote was recorded after the last refit started
+    """
+    generations = caching.get_generation_cache()
+    voted = generations.get(vote_time_key)
+    refit = generations.get(refit_time_key)
+    return voted is not None and (refit is None or voted >= refit)
+
+def refit_pending():
+    """
+    Refit the ratings while votes are pending, waiting until
+    PATCHES_RATING_REFIT_INTERVAL seconds have passed since the last refit
+    so that a burst of votes costs one refit. Returns straight away if
+    another worker holds the refit lock, it picks the votes up instead.
+    """
+    interval = getattr(settings, 'PATCHES_RATING_REFIT_INTERVAL', 60)
+    generations = caching.get_generation_cache()
+    while is_refit_pending():
+        if not caching.acquire_lock(refit_lock, interval+300):
+            return
+        try:
+            wait = (generations.get(refit_time_key) or 0)+interval-time.time()
+            if wait > 0:
+                time.sleep(wait)
+            refresh_ratings(warm_start=True, max_iter=refit_iterations)
+        finally:
+            caching.release_lock(refit_lock)
+
+def run():
+    try:
+        refit_pending()
+    except Exception as e:
+        logger.warning(f'Failed to refit ratings: {e}')
+    finally:
+        #Worker threads get their own connection, don't leave it open
+        connection.close()
+
+def schedule_refit():
+    """
+    Note that a vote was recorded and refit the ratings in the background
+    once the current transaction commits, see refit_pending. With
+    PATCHES_RATING_REFIT_ASYNC off, refit immediately instead.
+    """
+    def queue():
+        caching.get_generation_cache().set(vote_time_key, time.time(), None)
+        if getattr(settings, 'PATCHES_RATING_REFIT_ASYNC', True):
+            get_executor().submit(run)
+        else:
+            refit_pending()
+    transaction.on_commit(queue)
@@ -0,0 +1,204 @@
+"""
+Full-text search over entry names, descriptions, tag names and author
+display names.
+
+Two backends are available, chosen by PATCHES_SEARCH_BACKEND:
+    'terms' - an inverted index of words in SearchTerm, weighted by field,
+              queried with indexed prefix lookups. Works on any database.
+    'mysql' - a FULLTEXT index on SearchDocument, queried in boolean mode.
+              rebuild_search_index creates the index. Words the index
+              leaves out, i.e. stopwords and words shorter than
+              innodb_ft_min_token_size, are matched with LIKE instead.
+    'auto'  - 'mysql' on MySQL, 'terms' otherwise.
+
+Every word of a query must match the start of a word in the entry. Results
+are annotated with search_rank, higher is better.
+"""
+import re
+import math
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q, Sum, Subquery, OuterRef, FloatField, Value
+from django.db.models.functions import Concat
+from django.db.models.expressions import RawSQL
+
+from .models import PatchEntry, SearchTerm, SearchDocument
+
+word_re = re.compile(r'\w+')
+max_term_length = SearchTerm._meta.get_field('term').max_length
+#Words beyond this in a query are ignored
+max_query_terms = 8
+
+#InnoDB's default FULLTEXT stopwords, see INFORMATION_SCHEMA.INNODB_FT_DEFAULT_STOPWORD
+mysql_stopwords = frozenset([
+    'a', 'about', 'an', 'are', 'as', 'at', 'be', 'by', 'com', 'de', 'en', 'for',
+    'from', 'how', 'i', 'in', 'is', 'it', 'la', 'of', 'on', 'or', 'that', 'the',
+    'this', 'to', 'was', 'what', 'when', 'where', 'who', 'will', 'with', 'und',
+    'www',
+    ])
+
+#Relative weight of a word in each field
+field_weights = {
+    'name': 3.0,
+    'tags': 2.0,
+    'authors': 2.0,
+    'desc': 1.0,
+    }
+
+def tokenize(text):
+    """
+    Return the lowercased words in text
+    """
+    if not text:
+        return []
+    return [x[:max_term_length] for x in word_re.findall(text.lower())]
+
+def get_fields(entry):
+    """
+    Return a dictionary of field: text for entry. Tags and authors should
+    be prefetched.
+    """
+    return {
+        'name': entry.name,
+        'desc': entry.desc or '',
+        'tags': ' '.join(x.name for x in entry.tags.all()),
+        'authors': ' '.join(x.display_name for x in entry.authors.all()),
+        }
+
+def get_term_weights(fields):
+    """
+    Return a dictionary of term: weight for the given fields. Repeats of a
+    word count logarithmically.
+    """
+    weights = defaultdict(float)
+    for field, text in fields.items():
+        counts = defaultdict(int)
+        for term in tokenize(text):
+            counts[term] += 1
+        for term, count in counts.items():
+            weights[term] += field_weights[field]*(1+math.log(count))
+    return weights
+
+def get_prefix_filter(word):
+    """
+    Return the filter for the terms starting with word. A range rather than
+    startswith, which SQLite runs as a LIKE over the whole index.
+    """
+    return Q(term__gte=word, term__lt=word+'\uffff')
+
+class TermBackend:
+    def index(self, entries):
+        ids = [x.pk for x in entries]
+        terms = []
+        for entry in entries:
+            weights = get_term_weights(get_fields(entry))
+            terms.extend(SearchTerm(term=x, entry_id=entry.pk, weight=y) for x, y in weights.items())
+        with transaction.atomic():
+            SearchTerm.objects.filter(entry_id__in=ids).delete()
+            SearchTerm.objects.bulk_create(terms, batch_size=1000)
+
+    def search(self, q, words):
+        terms = SearchTerm.objects.order_by()
+        matched = Q()
+        for word in words:
+            q = q.filter(id__in=terms.filter(get_prefix_filter(word)).values('entry_id'))
+            matched |= get_prefix_filter(word)
+
+        rank = terms.filter(matched, entry=OuterRef('pk')).values('entry').annotate(
+            rank=Sum('weight')).values('rank')
+        return q.annotate(search_rank=Subquery(rank, output_field=FloatField()))
+
+class MySQLBackend:
+    #Read from the server on first use
+    min_token_size = None
+
+    def index(self, entries):
+        documents = []
+        for entry in entries:
+            fields = get_fields(entry)
+            #Stored as space separated words so that words missing from the
+            #FULLTEXT index can be found with LIKE. Fields are repeated to
+            #weight them, the FULLTEXT ranking has no weights.
+            text = ' '.join(' '.join(tokenize(text)*int(field_weights[field])) for field, text in fields.items())
+            documents.append(SearchDocument(entry_id=entry.pk, text=text))
+        with transaction.atomic():
+            SearchDocument.objects.filter(entry_id__in=[x.pk for x in entries]).delete()
+            SearchDocument.objects.bulk_create(documents, batch_size=1000)
+
+    def is_indexed(self, word):
+        """
+        Return True if word can be found with the FULLTEXT index. A required
+        word that isn't indexed would make every search containing it empty.
+        """
+        if MySQLBackend.min_token_size is None:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT @@innodb_ft_min_token_size')
+                MySQLBackend.min_token_size = int(cursor.fetchone()[0])
+        return len(word) >= MySQLBackend.min_token_size and word not in mysql_stopwords
+
+    def search(self, q, words):
+        indexed = [x for x in words if self.is_indexed(x)]
+        unindexed = [x for x in words if not self.is_indexed(x)]
+
+        if unindexed:
+            #Match the start of a word in the space separated document text
+            documents = SearchDocument.objects.annotate(words=Concat(Value(' '), 'text'))
+            for word in unindexed:
+                documents = documents.filter(words__contains=f' {word}')
+            q = q.filter(id__in=documents.values('entry_id'))
+
+        if not indexed:
+            return q.annotate(search_rank=Value(0.0, output_field=FloatField()))
+
+        table = connection.ops.quote_name(SearchDocument._meta.db_table)
+        entry_table = connection.ops.quote_name(PatchEntry._meta.db_table)
+        query = ' '.join(f'+{x}*' for x in indexed)
+        matches = RawSQL(f'SELECT entry_id FROM {table} WHERE MATCH(text) AGAINST (%s IN BOOLEAN MODE)', [query])
+        rank = RawSQL(
+            f'SELECT MATCH(text) AGAINST (%s IN BOOLEAN MODE) FROM {table} WHERE entry_id = {entry_table}.id',
+            [query], output_field=FloatField())
+        return q.filter(id__in=matches).annotate(search_rank=rank)
+
+    def ensure_index(self):
+        """
+        Create the FULLTEXT index if it doesn't exist yet
+        """
+        table = SearchDocument._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(f'SHOW INDEX FROM {connection.ops.quote_name(table)} WHERE Index_type = %s', ['FULLTEXT'])
+            if cursor.fetchall():
+                return False
+            cursor.execute(f'ALTER TABLE {connection.ops.quote_name(table)} ADD FULLTEXT INDEX {table}_text_ft (text)')
+        return True
+
+backends = {
+    'terms': TermBackend,
+    'mysql': MySQLBackend,
+    }
+
+def get_backend():
+    name = getattr(settings, 'PATCHES_SEARCH_BACKEND', 'auto')
+    if name == 'auto':
+        name = 'mysql' if connection.vendor == 'mysql' else 'terms'
+    return backends[name]()
+
+def index_entries(ids):
+    """
+    Update the search index for the entries with the given ids
+    """
+    entries = list(PatchEntry.objects.filter(id__in=list(ids)).only('id', 'name', 'desc').prefetch_related('tags', 'authors'))
+    if entries:
+        get_backend().index(entries)
+    return len(entries)
+
+def search(q, text):
+    """
+    Filter the PatchEntry queryset q to entries matching text and annotate
+    them with search_rank
+    """
+    words = tokenize(text)[:max_query_terms]
+    if not words:
+        return q
+    return get_backend().search(q, words)
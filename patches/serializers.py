@@ -1,4 +1,5 @@
 from rest_framework import serializers
+from rest_framework import permissions
 from .models import PatchEntry, PatchAuthorName
 from . import models
 from . import utils
@@ -13,7 +14,39 @@ class JsonListSer(serializers. ListSerializer):
         result = json.loads(result)
         return result
 
-class PatchAuthorSerializer(serializers.ModelSerializer):
+def get_sparse_params(request):
+    """
+    Return (fields, expand) given with ?fields= and ?expand= on a read
+    request as sets of names. fields is None when every field is wanted.
+    """
+    if request is None or request.method not in permissions.SAFE_METHODS:
+        return None, set()
+    fields = utils.get_list_param(request.GET, 'fields')
+    expand = set(utils.get_list_param(request.GET, 'expand'))
+    return (set(fields) if fields else None), expand
+
+class SparseFieldsMixin:
+    """
+    Serializer mixin limiting read responses to the fields listed in
+    ?fields=, and serializing the relations listed in ?expand= as nested
+    objects using expandable_fields. Unknown names are ignored.
+    """
+    #name: serializer class for the nested objects
+    expandable_fields = {}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sparse_fields, expand = get_sparse_params(self.context.get('request', None))
+        for name in expand & set(self.expandable_fields):
+            self.fields[name] = self.expandable_fields[name](many=True, read_only=True)
+        if self.sparse_fields is not None:
+            for name in set(self.fields) - self.sparse_fields:
+                self.fields.pop(name)
+
+    def is_requested(self, name):
+        return self.sparse_fields is None or name in self.sparse_fields
+
+class PatchAuthorSerializer(SparseFieldsMixin, serializers.ModelSerializer):
 
     class Meta:
         model = PatchAuthorName
@@ -25,28 +58,38 @@ class RepoAttachSerializer(serializers.ModelSerializer):
         list_serializer_class = JsonListSer
         exclude=['entry']
 
-class PatchImageSerializer(serializers.ModelSerializer):
+class PatchImageSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = models.PatchImages
         fields = '__all__'
+        read_only_fields = ['checksum', 'blake2b']
 
-class PatchAttachSerializer(serializers.ModelSerializer):
+class PatchAttachSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = models.PatchAttachments
         fields = '__all__'
+        read_only_fields = ['checksum', 'blake2b', 'original_name']
 
-class PatchTagSerializer(serializers.ModelSerializer):
+class PatchTagSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = models.PatchTag
-        fields = '__all__'
+        exclude = ['lower_name']
+        read_only_fields = ['entry_count', 'description_html', 'summary_html']
 
 
 
-class PatchEntrySerializer(serializers.ModelSerializer):
+class PatchEntrySerializer(SparseFieldsMixin, serializers.ModelSerializer):
     """
     Pass pk's for existing objects. To create new objects, pass to
     corresponding extra_field.
     """
+    expandable_fields = {
+        'authors': PatchAuthorSerializer,
+        'tags': PatchTagSerializer,
+        'images': PatchImageSerializer,
+        'attachments': PatchAttachSerializer,
+        }
+
     authors = serializers.SlugRelatedField(
         many=True, 
         slug_field='display_name',
@@ -71,8 +114,11 @@ class PatchEntrySerializer(serializers.ModelSerializer):
     class Meta:
         model = PatchEntry
         exclude = []
+        read_only_fields = ['duration', 'rating', 'peaks', 'desc_html', 'version', 'updated_at', 'recording_checksum', 'recording_basename',
+            'recording_size', 'recording_mime']
 
     def validate_extra_images(self, data):
+        #Uploads are hashed by the upload handler, see uploadhandlers.py
         checksums = {utils.generate_checksum(fp):fp for fp in data}
         q = models.PatchImages.objects.filter(checksum__in=checksums.keys())
         if q.count() != 0:
@@ -90,6 +136,8 @@ class PatchEntrySerializer(serializers.ModelSerializer):
 
     def to_representation(self, instance):
         res = super().to_representation(instance)
+        if not self.is_requested('absolute_url'):
+            return res
         try:
             res['absolute_url'] = self.context['request'].build_absolute_uri(instance.get_absolute_url())
         except AttributeError:
@@ -114,3 +162,16 @@ class PatchEntrySerializer(serializers.ModelSerializer):
         return entry
 
 
+
+
+class ResolveSerializer(serializers.Serializer):
+    """
+    Lists of identifiers to look up with ResolveAPIView
+    """
+    max_items = 1000
+
+    tags = serializers.ListField(child=serializers.CharField(), required=False, max_length=max_items)
+    authors = serializers.ListField(child=serializers.CharField(), required=False, max_length=max_items)
+    images = serializers.ListField(child=serializers.CharField(), required=False, max_length=max_items)
+    attachments = serializers.ListField(child=serializers.CharField(), required=False, max_length=max_items)
+    recordings = serializers.ListField(child=serializers.CharField(), required=False, max_length=max_items)
@@ -0,0 +1,197 @@
+from django.db.models.signals import m2m_changed, pre_delete, post_delete, pre_save, post_save
+from django.dispatch import receiver
+
+from .models import (PatchEntry, PatchTag, PatchAuthorName, PatchImages, PatchAttachments,
+    PatchRepoAttachment, AudioMetadata, BinaryQuestion)
+from . import caching
+from . import search
+
+##
+## Tag entry counts
+##
+
+@receiver(m2m_changed, sender=PatchEntry.tags.through)
+def update_tag_counts(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Keep PatchTag.entry_count current when tags are added to or removed from
+    an entry (or entries are added to or removed from a tag)
+    """
+    if action == 'pre_clear':
+        #Remember what is about to be cleared so it can be recounted
+        if reverse:
+            instance._cleared_tag_ids = [instance.pk]
+        else:
+            instance._cleared_tag_ids = list(instance.tags.values_list('id', flat=True))
+        return
+
+    if action == 'post_clear':
+        tag_ids = getattr(instance, '_cleared_tag_ids', [])
+    elif action in ('post_add', 'post_remove'):
+        tag_ids = [instance.pk] if reverse else list(pk_set)
+    else:
+        return
+
+    if tag_ids:
+        PatchTag.refresh_counts(tag_ids)
+
+@receiver(pre_delete, sender=PatchEntry)
+def remember_entry_tags(sender, instance, **kwargs):
+    """
+    Deleting an entry removes its through rows without sending m2m_changed
+    """
+    instance._deleted_tag_ids = list(instance.tags.values_list('id', flat=True))
+
+@receiver(post_delete, sender=PatchEntry)
+def update_deleted_entry_tags(sender, instance, **kwargs):
+    tag_ids = getattr(instance, '_deleted_tag_ids', [])
+    if tag_ids:
+        PatchTag.refresh_counts(tag_ids)
+
+##
+## Entry durations
+##
+
+@receiver(post_save, sender=AudioMetadata)
+def update_entry_duration(sender, instance, **kwargs):
+    """
+    Keep PatchEntry.duration in step with its AudioMetadata
+    """
+    PatchEntry.objects.filter(meta=instance).update(duration=instance.duration)
+
+##
+## Comparison pools
+##
+
+@receiver(post_save, sender=PatchEntry)
+@receiver(post_delete, sender=PatchEntry)
+def clear_entry_ids(sender, instance, **kwargs):
+    """
+    Drop the cached entry ids used to draw comparison pairs. Pairs that are
+    already pooled are checked against the database when they are drawn.
+    """
+    if kwargs.get('created', True):
+        BinaryQuestion.clear_entry_ids()
+
+##
+## Entry versions
+##
+
+@receiver(m2m_changed, sender=PatchEntry.tags.through)
+@receiver(m2m_changed, sender=PatchEntry.authors.through)
+@receiver(m2m_changed, sender=PatchEntry.images.through)
+@receiver(m2m_changed, sender=PatchEntry.attachments.through)
+def bump_related_versions(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Bump the version of entries whose tags, authors, images or attachments
+    were changed, from either side of the relation
+    """
+    ids = get_changed_entry_ids(sender, instance, action, reverse, pk_set)
+    if ids:
+        PatchEntry.bump_versions(ids)
+
+def get_changed_entry_ids(sender, instance, action, reverse, pk_set):
+    """
+    Return the ids of the entries affected by an m2m_changed signal on one
+    of PatchEntry's relations, or None before the change is made
+    """
+    if not reverse:
+        return [instance.pk] if action.startswith('post_') else None
+
+    if action == 'pre_clear':
+        #Through fields are named after their models
+        field = f'{type(instance)._meta.model_name}_id'
+        instance._cleared_entry_ids = list(sender.objects.filter(**{field: instance.pk}).values_list('patchentry_id', flat=True))
+    elif action == 'post_clear':
+        return getattr(instance, '_cleared_entry_ids', [])
+    elif action in ('post_add', 'post_remove'):
+        return list(pk_set)
+    return None
+
+@receiver(post_save, sender=PatchTag)
+@receiver(post_save, sender=PatchAuthorName)
+@receiver(post_save, sender=PatchImages)
+@receiver(post_save, sender=PatchAttachments)
+def bump_shared_versions(sender, instance, created, **kwargs):
+    """
+    Bump the version of every entry showing a tag, author, image or
+    attachment that was edited
+    """
+    if not created:
+        PatchEntry.bump_versions(instance.patchentry_set.values_list('id', flat=True))
+
+@receiver(post_save, sender=PatchRepoAttachment)
+@receiver(post_delete, sender=PatchRepoAttachment)
+def bump_repo_version(sender, instance, **kwargs):
+    PatchEntry.bump_versions([instance.entry_id])
+
+##
+## Search index
+##
+
+@receiver(post_save, sender=PatchEntry)
+def index_entry(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not {'name', 'desc'} & set(update_fields):
+        return
+    search.index_entries([instance.pk])
+
+@receiver(m2m_changed, sender=PatchEntry.tags.through)
+@receiver(m2m_changed, sender=PatchEntry.authors.through)
+def index_related_entries(sender, instance, action, reverse, pk_set, **kwargs):
+    ids = get_changed_entry_ids(sender, instance, action, reverse, pk_set)
+    if ids:
+        search.index_entries(ids)
+
+#Indexed name field of the models entries are searched by
+indexed_names = {
+    PatchTag: 'name',
+    PatchAuthorName: 'display_name',
+    }
+
+@receiver(pre_save, sender=PatchTag)
+@receiver(pre_save, sender=PatchAuthorName)
+def check_renamed(sender, instance, **kwargs):
+    field = indexed_names[sender]
+    old = sender.objects.filter(pk=instance.pk).values_list(field, flat=True).first() if instance.pk else None
+    instance._renamed = old is not None and old != getattr(instance, field)
+
+@receiver(post_save, sender=PatchTag)
+@receiver(post_save, sender=PatchAuthorName)
+def index_renamed_entries(sender, instance, created, **kwargs):
+    """
+    Reindex the entries of a renamed tag or author
+    """
+    if getattr(instance, '_renamed', False):
+        search.index_entries(instance.patchentry_set.values_list('id', flat=True))
+
+##
+## Cache generations
+##
+
+@receiver(post_save, sender=PatchEntry)
+@receiver(post_delete, sender=PatchEntry)
+@receiver(post_save, sender=PatchTag)
+@receiver(post_delete, sender=PatchTag)
+@receiver(post_save, sender=PatchAuthorName)
+@receiver(post_delete, sender=PatchAuthorName)
+@receiver(m2m_changed, sender=PatchEntry.tags.through)
+@receiver(m2m_changed, sender=PatchEntry.authors.through)
+@receiver(m2m_changed, sender=PatchEntry.images.through)
+@receiver(m2m_changed, sender=PatchEntry.attachments.through)
+@receiver(post_save, sender=PatchRepoAttachment)
+@receiver(post_delete, sender=PatchRepoAttachment)
+def bump_entries_generation(sender, **kwargs):
+    """
+    Invalidate cached pages, feeds and API responses built from entries
+    """
+    if kwargs.get('action', 'post_').startswith('post_'):
+        caching.bump_generation('entries')
+
+@receiver(post_save, sender=PatchImages)
+@receiver(post_delete, sender=PatchImages)
+def bump_images_generation(sender, **kwargs):
+    caching.bump_generation('images')
+
+@receiver(post_save, sender=PatchAttachments)
+@receiver(post_delete, sender=PatchAttachments)
+def bump_attachments_generation(sender, **kwargs):
+    caching.bump_generation('attachments')
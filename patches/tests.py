@@ -1,3 +1,531 @@
-from django.test import TestCase
+import io
+import os
+import math
+import time
+import wave
+import hashlib
+import shutil
+import struct
+import datetime
+import tempfile
+import threading
+import unittest
+from unittest import mock
 
-# Create your tests here.
+from django.db import connection, connections
+from django.test import TestCase, TransactionTestCase, RequestFactory, override_settings
+from django.http import HttpResponse, QueryDict
+from django.views import View
+from django.middleware.csrf import get_token
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.utils import timezone
+from django.contrib.auth.models import User
+
+from licensing.models import License
+from .models import (PatchEntry, PatchAuthorName, PatchTag, PatchAttachments, BinaryQuestion, BinaryAnswer,
+    BinaryResponseDetail)
+from . import views
+from . import pagination
+from . import votebuffer
+from . import ranking
+from . import caching
+from . import search
+
+def wav_bytes(seconds=0.1, rate=8000):
+    """
+    Return a short mono 16 bit wav file as bytes
+    """
+    frames = b''.join(struct.pack('<h', int(10000*math.sin(i/10))) for i in range(int(seconds*rate)))
+    out = io.BytesIO()
+    with wave.open(out, 'wb') as fp:
+        fp.setnchannels(1)
+        fp.setsampwidth(2)
+        fp.setframerate(rate)
+        fp.writeframes(frames)
+    return out.getvalue()
+
+test_caches = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'patches-tests'}}
+
+class EntryTestCase(TestCase):
+    """
+    Creates entries with recordings, authors and tags in a temporary
+    MEDIA_ROOT
+    """
+    entry_count = 12
+
+    @classmethod
+    def setUpClass(cls):
+        cls.media_root = tempfile.mkdtemp()
+        cls.media_settings = override_settings(MEDIA_ROOT=cls.media_root, CACHES=test_caches,
+            PATCHES_LOCK_DIR=os.path.join(cls.media_root, 'locks'))
+        cls.media_settings.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.media_settings.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+
+    def setUp(self):
+        cache.clear()
+
+    @classmethod
+    def setUpTestData(cls):
+        license = License.objects.create(name='CC BY', symbols='cc', url='http://example.com')
+        authors = [PatchAuthorName.objects.create(display_name=f'author {i}',
+            user=User.objects.create(username=f'user{i}')) for i in range(3)]
+        tags = [PatchTag.objects.create(name=f'tag {i}', description=f'*tag* {i}') for i in range(4)]
+        now = timezone.now()
+        for i in range(cls.entry_count):
+            entry = PatchEntry(name=f'entry {i}', desc=f'*entry* {i}', license=license,
+                date=now-datetime.timedelta(days=i))
+            entry.recording.save(f'entry{i}.wav', ContentFile(wav_bytes(0.1+i*0.01)), save=False)
+            entry.save()
+            entry.authors.add(*authors[:1+i%3])
+            entry.tags.add(*tags[:1+i%4])
+
+class QueryBudgetTests(EntryTestCase):
+    """
+    The number of queries for a page of entries doesn't depend on the
+    number of entries on it. The cache is cleared before each request so
+    that pages are rendered in full.
+    """
+    def setUp(self):
+        super().setUp()
+        #Load per-process caches such as the current site first
+        self.client.get('/en/audio/')
+    def test_index(self):
+        for page_size in (5, 10):
+            cache.clear()
+            with mock.patch.object(views.IndexView, 'paginate_by', page_size):
+                with self.assertNumQueries(9):
+                    response = self.client.get('/en/audio/')
+            self.assertEqual(len(response.context['patch_entries']), page_size)
+
+    def test_feed(self):
+        for page_size in (5, 10):
+            cache.clear()
+            with mock.patch.object(views.IndexFeed, 'items_per_page', page_size):
+                with self.assertNumQueries(7):
+                    response = self.client.get('/en/audio/rss/')
+            self.assertEqual(response.content.count(b'<item>'), page_size)
+
+    def test_api_list(self):
+        for page_size in (5, 10):
+            cache.clear()
+            with mock.patch.object(pagination.EntryPagination, 'page_size', page_size):
+                with self.assertNumQueries(8):
+                    response = self.client.get('/en/audio/api/entries/')
+            self.assertEqual(len(response.json()['results']), page_size)
+
+class KeysetTests(EntryTestCase):
+    def setUp(self):
+        super().setUp()
+        pks = list(PatchEntry.objects.order_by('id').values_list('pk', flat=True))
+        PatchEntry.objects.filter(pk__in=pks[::3]).update(duration=None)
+        for i, pk in enumerate(pks[1::2]):
+            PatchEntry.objects.filter(pk=pk).update(rating=i%3)
+
+    def walk(self, url):
+        pks = []
+        while url:
+            data = self.client.get(url).json()
+            pks += [x['id'] for x in data['results']]
+            url = data['next']
+        return pks
+
+    def test_null_values(self):
+        for params in [{'order_by': 'length'}, {'order_by': 'length', 'ascending': '1'},
+                {'order_by': 'rating'}, {'order_by': 'rating', 'ascending': '1'}]:
+            expected = list(views.order_entries(PatchEntry.objects.all(), params, False)
+                .values_list('pk', flat=True))
+            with mock.patch.object(pagination.EntryPagination, 'page_size', 5):
+                pks = self.walk('/en/audio/api/entries/?'+'&'.join(f'{k}={v}' for k, v in params.items()))
+            self.assertEqual(pks, expected)
+
+    def test_count_follows_generation(self):
+        url = '/en/audio/api/entries/'
+        self.assertEqual(self.client.get(url).json()['count'], self.entry_count)
+        PatchEntry.objects.first().delete()
+        self.assertEqual(self.client.get(url).json()['count'], self.entry_count-1)
+
+class ConditionalGetTests(EntryTestCase):
+    def test_etag(self):
+        for url in ['/en/audio/api/entries/', '/en/audio/api/tags/', '/en/audio/api/authors/']:
+            response = self.client.get(url)
+            #Only django-cms' url revision check
+            with self.assertNumQueries(1):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(response.status_code, 304)
+
+    def test_if_modified_since_same_second(self):
+        response = self.client.get('/en/audio/api/entries/')
+        self.assertEqual(self.client.get('/en/audio/api/entries/',
+            HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+        PatchTag.objects.create(name='new tag')
+        response = self.client.get('/en/audio/api/tags/', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 200)
+
+class TokenView(caching.AnonymousCacheMixin, View):
+    def get(self, request):
+        return HttpResponse(get_token(request))
+
+class SlowView(caching.AnonymousCacheMixin, View):
+    renders = 0
+
+    def get(self, request):
+        type(self).renders += 1
+        time.sleep(0.2)
+        return HttpResponse(f'render {self.renders}')
+
+@override_settings(CACHES=test_caches)
+class PageCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.lock_dir, ignore_errors=True)
+        lock_settings = override_settings(PATCHES_LOCK_DIR=self.lock_dir)
+        lock_settings.enable()
+        self.addCleanup(lock_settings.disable)
+
+    def make_request(self, path):
+        request = RequestFactory().get(path)
+        request.user = AnonymousUser()
+        request._messages = CookieStorage(request)
+        return request
+
+    def test_csrf_token_not_cached(self):
+        view = TokenView.as_view()
+        first = view(self.make_request('/token/'))
+        second = view(self.make_request('/token/'))
+        self.assertNotEqual(first.content, second.content)
+
+    def test_blank_params_in_key(self):
+        mixin = caching.AnonymousCacheMixin()
+        self.assertNotEqual(mixin.get_response_cache_key(self.make_request('/?cursor=')),
+            mixin.get_response_cache_key(self.make_request('/')))
+
+    @override_settings(CACHES=dict(test_caches, generations={
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'patches-tests-generations'}))
+    def test_generations_survive_default_cache(self):
+        generation = caching.bump_generation('entries')
+        cache.clear()
+        self.assertEqual(caching.get_generation('entries'), generation)
+
+    def test_lock(self):
+        self.assertTrue(caching.acquire_lock('job', 30))
+        self.assertFalse(caching.acquire_lock('job', 30))
+        caching.release_lock('job')
+        self.assertTrue(caching.acquire_lock('job', 30))
+        #Left by a worker that died
+        path = caching.get_lock_path('job')
+        os.utime(path, (time.time()-60, time.time()-60))
+        self.assertTrue(caching.acquire_lock('job', 30))
+
+    def test_contended_rebuild(self):
+        """
+        Requests arriving together for a missing page render it once, with
+        the file cache the site uses
+        """
+        file_caches = {'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.path.join(self.lock_dir, 'cache')}}
+        with override_settings(CACHES=file_caches):
+            self.check_contended_rebuild()
+
+    def check_contended_rebuild(self):
+        SlowView.renders = 0
+        view = SlowView.as_view()
+        barrier = threading.Barrier(8)
+        results = []
+        def get():
+            request = self.make_request('/slow/')
+            barrier.wait()
+            results.append(view(request).content)
+        threads = [threading.Thread(target=get) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(SlowView.renders, 1)
+        self.assertEqual(results, [b'render 1']*8)
+
+    def test_stale_copy_while_locked(self):
+        SlowView.renders = 0
+        view = SlowView.as_view()
+        view(self.make_request('/slow/'))
+        caching.bump_generation('entries')
+        key = SlowView().get_response_cache_key(self.make_request('/slow/'))
+        self.assertTrue(caching.acquire_lock(key+':lock', 30))
+        self.assertEqual(view(self.make_request('/slow/')).content, b'render 1')
+        self.assertEqual(SlowView.renders, 1)
+        caching.release_lock(key+':lock')
+        self.assertEqual(view(self.make_request('/slow/')).content, b'render 2')
+
+    def test_toolbar_not_cached(self):
+        mixin = caching.AnonymousCacheMixin()
+        self.assertFalse(mixin.is_cacheable_request(self.make_request('/?edit')))
+
+@override_settings(PATCHES_SEARCH_BACKEND='terms')
+class TermSearchTests(EntryTestCase):
+    entry_count = 2
+
+    def test_prefix_match(self):
+        search.index_entries(PatchEntry.objects.values_list('id', flat=True))
+        self.assertEqual(search.search(PatchEntry.objects.all(), 'ent').count(), 2)
+        self.assertEqual(search.search(PatchEntry.objects.all(), 'entries').count(), 0)
+
+    @unittest.skipIf(connection.vendor != 'sqlite', 'Checks the SQLite query plan')
+    def test_prefix_uses_index(self):
+        plan = search.search(PatchEntry.objects.all(), 'entry tag').explain()
+        terms = [x for x in plan.splitlines() if 'patches_searchterm' in x]
+        self.assertTrue(terms)
+        for line in terms:
+            self.assertIn('SEARCH', line)
+            self.assertNotIn('SCAN', line)
+
+@override_settings(PATCHES_SEARCH_BACKEND='mysql')
+class MySQLSearchTests(EntryTestCase):
+    entry_count = 2
+
+    def test_unindexed_words(self):
+        """
+        Stopwords and short words aren't in the FULLTEXT index and are
+        matched without it
+        """
+        search.index_entries(PatchEntry.objects.values_list('id', flat=True))
+        entry = PatchEntry.objects.order_by('id').first()
+        entry.name = 'dj set'
+        entry.save()
+        with mock.patch.object(search.MySQLBackend, 'min_token_size', 3):
+            self.assertEqual(list(search.search(PatchEntry.objects.all(), 'dj')), [entry])
+            self.assertEqual(search.search(PatchEntry.objects.all(), 'en').count(), 2)
+            self.assertEqual(search.search(PatchEntry.objects.all(), 'd j').count(), 0)
+
+class FeedTests(EntryTestCase):
+    def test_if_modified_since_same_second(self):
+        response = self.client.get('/en/audio/rss/')
+        entry = PatchEntry.objects.order_by('-date').first()
+        entry.name = 'renamed'
+        entry.save()
+        response = self.client.get('/en/audio/rss/', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'renamed', response.content)
+
+class IndexTests(EntryTestCase):
+    def test_entry_without_metadata(self):
+        entry = PatchEntry.objects.order_by('-date').first()
+        PatchEntry.objects.filter(pk=entry.pk).update(meta=None, duration=None)
+        response = self.client.get('/en/audio/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(entry, response.context['patch_entries'])
+
+    def test_cards_shared_between_orderings(self):
+        entry = PatchEntry.objects.order_by('-date').first()
+        self.client.get('/en/audio/')
+        #update() doesn't bump the version, so a reused card keeps the old name
+        PatchEntry.objects.filter(pk=entry.pk).update(name='renamed')
+        response = self.client.get('/en/audio/', {'order_by': 'length', 'ascending': '1'})
+        self.assertIn(entry, response.context['patch_entries'])
+        self.assertNotContains(response, 'renamed')
+        #The links still follow the querystring
+        self.assertContains(response, 'order_by=length')
+
+    def test_rebuild_markdown_bumps_versions(self):
+        versions = dict(PatchEntry.objects.values_list('id', 'version'))
+        call_command('rebuild_markdown', stdout=io.StringIO())
+        for pk, version in PatchEntry.objects.values_list('id', 'version'):
+            self.assertEqual(version, versions[pk]+1)
+
+class TagFilterTests(EntryTestCase):
+    def test_case_insensitive(self):
+        expected = set(PatchEntry.objects.filter(tags__name='tag 1').filter(tags__name='tag 2')
+            .values_list('id', flat=True))
+        q = views.filter_entry_tags(PatchEntry.objects.all(), QueryDict('tags=TAG 1,Tag 2'))
+        self.assertEqual(set(q.values_list('id', flat=True)), expected)
+        self.assertTrue(expected)
+
+    @unittest.skipIf(connection.vendor != 'sqlite', 'Checks the SQLite query plan')
+    def test_tag_name_index(self):
+        q = views.filter_entry_tags(PatchEntry.objects.all(), QueryDict('tags=TAG 1&any_tags=tag 2'))
+        plan = q.explain()
+        self.assertIn('lower_name', plan)
+        self.assertNotIn('SCAN', plan)
+
+class RecordingNameTests(EntryTestCase):
+    entry_count = 1
+
+    def test_saved_before_entry(self):
+        """
+        recording.save(name, content, save=False) then save() keeps the
+        name the recording was saved under
+        """
+        entry = PatchEntry.objects.get()
+        entry.recording.save('orig.wav', ContentFile(wav_bytes(0.2)), save=False)
+        self.assertNotEqual(os.path.basename(entry.recording.name), 'orig.wav')
+        entry.save()
+        entry.refresh_from_db()
+        self.assertEqual(entry.recording_basename, 'orig.wav')
+        response = self.client.get('/en/audio/api/entries/', {'filenames': 'orig.wav'})
+        self.assertEqual([x['id'] for x in response.json()['results']], [entry.pk])
+
+class AttachmentTests(EntryTestCase):
+    entry_count = 0
+
+    def test_resave_closes_file(self):
+        attachment = PatchAttachments()
+        attachment.file.save('notes.txt', ContentFile(b'notes'), save=False)
+        attachment.save()
+        attachment = PatchAttachments.objects.get()
+        attachment.checksum = None
+        attachment.save()
+        self.assertEqual(attachment.checksum, hashlib.md5(b'notes').hexdigest())
+        self.assertTrue(attachment.file.closed)
+        self.assertEqual(attachment.original_name, 'notes.txt')
+
+class VoteBufferTests(EntryTestCase):
+    entry_count = 2
+
+    def test_replayed_votes_are_skipped(self):
+        question = BinaryQuestion.objects.create(question='Is A better than B?',
+            answer_a='yes', answer_b='no', slug='better')
+        entry_a, entry_b = PatchEntry.objects.order_by('id')
+        path = f'{self.media_root}/votes.log'
+        with override_settings(PATCHES_VOTE_BUFFER={'PATH': path}):
+            for i in range(3):
+                votebuffer.append_vote(question.id, entry_a.id, entry_b.id, True, 'test')
+            with open(path) as fp:
+                log = fp.read()
+            self.assertEqual(votebuffer.flush(), 3)
+
+            #A crash after the batch committed but before the checkpoint was
+            #written leaves the log to be flushed again
+            with open(path+'.flushing', 'w') as fp:
+                fp.write(log)
+            self.assertEqual(votebuffer.flush(), 0)
+
+        answer = BinaryAnswer.objects.get()
+        self.assertEqual(answer.count_a, 3)
+        self.assertEqual(BinaryResponseDetail.objects.count(), 3)
+
+@override_settings(PATCHES_RATING_REFIT_ASYNC=False, PATCHES_RATING_REFIT_INTERVAL=0.5)
+class RatingRefitTests(EntryTestCase):
+    entry_count = 2
+
+    def setUp(self):
+        super().setUp()
+        question = BinaryQuestion.objects.create(question='Is A better than B?',
+            answer_a='yes', answer_b='no', slug='better')
+        self.entry_a, self.entry_b = PatchEntry.objects.order_by('id')
+        self.data = {'answer': 'a', 'question_id': question.id,
+            'entry_a_id': self.entry_a.id, 'entry_b_id': self.entry_b.id}
+        #TestCase never commits, run the callbacks straight away
+        on_commit = mock.patch.object(ranking.transaction, 'on_commit', lambda x: x())
+        on_commit.start()
+        self.addCleanup(on_commit.stop)
+
+    def vote(self):
+        self.client.post('/en/audio/compare/', self.data)
+
+    def test_vote_refits_ratings(self):
+        with mock.patch.object(ranking, 'refresh_ratings', wraps=ranking.refresh_ratings) as refresh:
+            start = time.monotonic()
+            self.vote()
+            self.vote()
+        #The second vote lands within the interval and is refit once it ends
+        self.assertEqual(refresh.call_count, 2)
+        self.assertGreaterEqual(time.monotonic()-start, 0.5)
+        self.assertFalse(ranking.is_refit_pending())
+        self.entry_a.refresh_from_db()
+        self.entry_b.refresh_from_db()
+        self.assertGreater(self.entry_a.rating, self.entry_b.rating)
+
+    def test_locked_refit_left_pending(self):
+        self.assertTrue(caching.acquire_lock(ranking.refit_lock, 30))
+        with mock.patch.object(ranking, 'refresh_ratings') as refresh:
+            self.vote()
+        refresh.assert_not_called()
+        self.assertTrue(ranking.is_refit_pending())
+        caching.release_lock(ranking.refit_lock)
+        ranking.refit_pending()
+        self.assertFalse(ranking.is_refit_pending())
+        self.entry_a.refresh_from_db()
+        self.assertIsNotNone(self.entry_a.rating)
+
+    @override_settings(PATCHES_RATING_REFIT_ASYNC=True)
+    def test_refit_outside_request(self):
+        with mock.patch.object(ranking, 'get_executor') as get_executor, \
+                mock.patch.object(ranking, 'refresh_ratings') as refresh:
+            self.vote()
+        refresh.assert_not_called()
+        get_executor.return_value.submit.assert_called_once_with(ranking.run)
+
+class RefreshMetadataTests(EntryTestCase):
+    entry_count = 2
+
+    def test_shared_recording(self):
+        entry_a, entry_b = PatchEntry.objects.order_by('id')
+        PatchEntry.objects.filter(pk=entry_b.pk).update(recording=entry_a.recording.name)
+        PatchEntry.objects.update(meta=None, duration=None)
+        #Closing the connection would end the test's transaction, the worker
+        #processes don't use it
+        with mock.patch.object(connections, 'close_all'):
+            call_command('refresh_metadata', '--workers', '1', stdout=io.StringIO())
+        durations = set(PatchEntry.objects.values_list('duration', flat=True))
+        self.assertEqual(len(durations), 1)
+        self.assertIsNotNone(durations.pop())
+
+    def test_tag_option(self):
+        PatchEntry.objects.update(meta=None, duration=None)
+        tagged = set(PatchEntry.objects.filter(tags__name='tag 1').values_list('id', flat=True))
+        with mock.patch.object(connections, 'close_all'):
+            call_command('refresh_metadata', '--workers', '1', '--tag', 'TAG 1', stdout=io.StringIO())
+        self.assertEqual(len(tagged), 1)
+        self.assertEqual(set(PatchEntry.objects.filter(duration__isnull=False).values_list('id', flat=True)), tagged)
+
+class ConcurrentVoteTests(TransactionTestCase):
+    """
+    Votes on the same pair from many threads at once are all counted
+    """
+    threads = 8
+
+    def test_record_vote(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        with override_settings(MEDIA_ROOT=media_root, CACHES=test_caches):
+            license = License.objects.create(name='CC BY', symbols='cc', url='http://example.com')
+            entries = []
+            for i in range(2):
+                entry = PatchEntry(name=f'entry {i}', license=license, date=timezone.now())
+                entry.recording.save(f'entry{i}.wav', ContentFile(wav_bytes()), save=False)
+                entry.save()
+                entries.append(entry)
+        question = BinaryQuestion.objects.create(question='Is A better than B?',
+            answer_a='yes', answer_b='no', slug='better')
+
+        barrier = threading.Barrier(self.threads)
+        errors = []
+        def vote(selected_a):
+            try:
+                barrier.wait()
+                BinaryAnswer.record_vote(question.id, entries[0].id, entries[1].id, selected_a, 'test')
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=vote, args=(i % 2 == 0,)) for i in range(self.threads)]
+        for x in workers:
+            x.start()
+        for x in workers:
+            x.join()
+
+        self.assertEqual(errors, [])
+        answer = BinaryAnswer.objects.get()
+        self.assertEqual(answer.count_a+answer.count_b, self.threads)
+        self.assertEqual(answer.count_a, self.threads//2)
+        self.assertEqual(BinaryResponseDetail.objects.filter(answer=answer).count(), self.threads)
@@ -0,0 +1,71 @@
+"""
+Eager thumbnail generation for PatchImages.
+
+Saving a PatchImages queues every THUMBNAIL_ALIASES rendition to be built in
+a background thread once the transaction commits, and the resulting urls
+are stored on PatchImages.thumbnail_urls so that rendering a page never has
+to touch the thumbnail storage.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from easy_thumbnails.alias import aliases
+from easy_thumbnails.files import get_thumbnailer
+
+from . import caching
+
+logger = logging.getLogger(__name__)
+
+executor = None
+
+def get_executor():
+    global executor
+    if executor is None:
+        executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'PATCHES_THUMBNAIL_WORKERS', 2),
+            thread_name_prefix='thumbnails',
+            )
+    return executor
+
+def generate_thumbnails(image):
+    """
+    Build every aliased thumbnail of the PatchImages image and store their
+    urls. Return the urls as a dictionary of alias: url
+    """
+    thumbnailer = get_thumbnailer(image.image)
+    urls = {}
+    for alias in aliases.all(thumbnailer.alias_target):
+        urls[alias] = thumbnailer[alias].url
+    type(image).objects.filter(pk=image.pk).update(thumbnail_urls=urls)
+    image.thumbnail_urls = urls
+    #update() skips the post_save signal bumping the entries showing image
+    entries = image.patchentry_set
+    entries.model.bump_versions(entries.values_list('id', flat=True))
+    caching.bump_generation('images')
+    return urls
+
+def run(model, pk):
+    try:
+        image = model.objects.get(pk=pk)
+        generate_thumbnails(image)
+    except Exception as e:
+        logger.warning(f'Failed to generate thumbnails for image {pk}: {e}')
+    finally:
+        #Worker threads get their own connection, don't leave it open
+        connection.close()
+
+def schedule(image):
+    """
+    Generate the thumbnails for image in the background after the current
+    transaction commits. With PATCHES_THUMBNAIL_ASYNC off, generate them
+    immediately instead.
+    """
+    model = type(image)
+    pk = image.pk
+    if getattr(settings, 'PATCHES_THUMBNAIL_ASYNC', True):
+        transaction.on_commit(lambda: get_executor().submit(run, model, pk))
+    else:
+        transaction.on_commit(lambda: generate_thumbnails(model.objects.get(pk=pk)))
@@ -0,0 +1,36 @@
+"""
+Upload handlers that hash files while they stream in, so that uploaded
+files never have to be read back to be checksummed. The digests are stored
+on the UploadedFile as file.checksums and picked up by
+utils.generate_checksums.
+"""
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+
+from .utils import new_hashers
+
+class ChecksumUploadMixin:
+    def new_file(self, *args, **kwargs):
+        #Set up before super, the memory handler stops the chain when it
+        #takes the file
+        self.hashers = new_hashers()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        data = super().receive_data_chunk(raw_data, start)
+        if data is None:
+            #This handler consumed the chunk
+            for hasher in self.hashers.values():
+                hasher.update(raw_data)
+        return data
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.checksums = {name:hasher.hexdigest() for name, hasher in self.hashers.items()}
+        return file
+
+class ChecksumMemoryFileUploadHandler(ChecksumUploadMixin, MemoryFileUploadHandler):
+    pass
+
+class ChecksumTemporaryFileUploadHandler(ChecksumUploadMixin, TemporaryFileUploadHandler):
+    pass
@@ -22,7 +22,12 @@ urlpatterns = [
     path('compare/<int:pk>/', views.CompareView.as_view(), name='compare'),
     path('tags/', views.TagView.as_view(), name='tags'),
 
+    path('<int:pk>/recording/', views.download_recording, name='recording'),
+    path('images/<int:pk>/', views.download_image, name='image'),
+    path('attachments/<int:pk>/', views.download_attachment, name='attachment'),
+
     path('api-auth/', include('rest_framework.urls')),
+    path('api/resolve/', views.ResolveAPIView.as_view(), name='resolve'),
     path('api/', include(api_router.urls)),
 
 
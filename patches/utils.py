@@ -1,9 +1,42 @@
 import hashlib
 
-def generate_checksum(fp):
-    md5 = hashlib.md5()
+#Digests kept for uploaded files. md5 is the legacy checksum column, blake2b
+#is faster to compute on 64 bit machines.
+hash_names = ('md5', 'blake2b')
+
+def new_hashers():
+    return {name:hashlib.new(name) for name in hash_names}
+
+def generate_checksums(fp):
+    """
+    Return a dictionary of hash name: hex digest for fp. Digests computed
+    while the file was uploaded, or by an earlier call, are reused instead
+    of reading the file again.
+    """
+    checksums = getattr(fp, 'checksums', None)
+    if checksums:
+        return checksums
+
+    hashers = new_hashers()
     for chunk in fp.chunks():
-        md5.update(chunk)
-    return md5.hexdigest()
+        for hasher in hashers.values():
+            hasher.update(chunk)
+    checksums = {name:hasher.hexdigest() for name, hasher in hashers.items()}
+    try:
+        fp.checksums = checksums
+    except AttributeError:
+        pass
+    return checksums
 
+def generate_checksum(fp):
+    return generate_checksums(fp)['md5']
 
+def get_list_param(params, key):
+    """
+    Return the values of a list parameter given either as repeated keys or
+    as a comma separated list
+    """
+    result = []
+    for value in params.getlist(key):
+        result.extend(x for x in value.split(',') if x)
+    return result
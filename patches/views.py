@@ -4,9 +4,11 @@ import hashlib
 import datetime
 import mimetypes
 
+from django.conf import settings
 from django.shortcuts import render, get_object_or_404
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, FileResponse, Http404
 from django.views import generic
+from django.views.decorators.http import require_safe
 from django.contrib.syndication.views import Feed
 
 from django.core.exceptions import ObjectDoesNotExist
@@ -16,14 +18,27 @@ from django.contrib import messages
 from django.urls import reverse
 from django.utils.feedgenerator import Enclosure, Rss201rev2Feed
 
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Q, F, Count
+from django.db.models.functions import Lower
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from django.core.cache import cache
 
 from tttweb.templatetags import tttcms_tags 
 from tttweb import secret_configs
 from .models import PatchEntry, PatchAuthorName, BinaryQuestion, PatchTag
 from . import models
+from . import votebuffer
+from . import downloads
+from . import caching
+from . import search
+from . import ranking
+from . import pagination
 
 from .serializers import PatchEntrySerializer,PatchAuthorSerializer
+from .utils import get_list_param
 from . import serializers
 
 from rest_framework import generics
@@ -32,6 +47,7 @@ from rest_framework.response import Response
 from rest_framework import status
 from rest_framework import permissions
 from rest_framework import viewsets
+from rest_framework.decorators import action
 
 class IsAuthorOrReadOnly(permissions.IsAuthenticatedOrReadOnly):
     def has_object_permission(self, request, view, obj):
@@ -67,38 +83,126 @@ class APIDryRun:
 
    
 
-class PatchEntryAPIVS(APIDryRun, viewsets.ModelViewSet):
+class SparseFieldsViewMixin:
+    """
+    Prefetch only the relations used by the fields requested with ?fields=,
+    see serializers.SparseFieldsMixin
+    """
+    #field name: relations to prefetch when the field is serialized
+    field_prefetches = {}
+
+    def get_queryset(self):
+        q = super().get_queryset()
+        fields, expand = serializers.get_sparse_params(self.request)
+        lookups = []
+        for name, relations in self.field_prefetches.items():
+            if fields is None or name in fields:
+                lookups.extend(relations)
+        return q.prefetch_related(*lookups)
+
+class ConditionalGetMixin:
+    """
+    Conditional GET for API list and detail views. The ETag and
+    Last-Modified come from the generations named in cache_generations, so
+    a request for unchanged data gets a 304 before anything is queried or
+    serialized.
+    """
+    cache_generations = ('entries',)
+
+    def get_validators(self, request):
+        """
+        Return (etag, last modified timestamp) for request
+        """
+        generation = [caching.get_generation(x) for x in self.cache_generations]
+        #Urls in responses are absolute and the format depends on Accept
+        key = caching.make_key('api', generation, request.scheme, request.get_host(), request.path,
+            tttcms_tags.sorted_querystring(request.GET), request.META.get('HTTP_ACCEPT', ''))
+        #Generations are whole seconds, see caching.bump_generation
+        return quote_etag(key), max(generation)
+
+    def conditional_response(self, handler, request, *args, **kwargs):
+        etag, last_modified = self.get_validators(request)
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = handler(request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(last_modified)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional_response(super().retrieve, request, *args, **kwargs)
+
+def get_entry_queryset(q=None):
+    """
+    Return a PatchEntry queryset that loads every relation used by
+    patches/entry.html, the RSS feed and PatchEntrySerializer up front, so
+    that rendering a page costs a fixed number of queries.
+    """
+    if q is None:
+        q = PatchEntry.objects.all()
+    return q.select_related('meta', 'license').prefetch_related(
+        'images',
+        'authors',
+        'tags',
+        'attachments',
+        'repo_attachments',
+        )
+
+class PatchEntryAPIVS(ConditionalGetMixin, SparseFieldsViewMixin, APIDryRun, viewsets.ModelViewSet):
     queryset = PatchEntry.objects.all()
     serializer_class = PatchEntrySerializer
     permission_classes=[IsAuthorOrReadOnly]
+    pagination_class = pagination.EntryPagination
+    cache_generations = ('entries', 'images', 'attachments')
+    field_prefetches = {
+        'authors': ['authors'],
+        'tags': ['tags'],
+        'images': ['images'],
+        'attachments': ['attachments'],
+        'repo_attachments': ['repo_attachments'],
+        }
 
     def get_queryset(self):
         q = super().get_queryset()
         names = self.request.GET.getlist('names', None)
+        #Filenames may contain commas, so only repeated keys
         filenames = self.request.GET.getlist('filenames', None)
+        checksums = get_list_param(self.request.GET, 'checksums')
 
+        #Each filter is a single IN lookup
         result = q
         if names:
-            tresult = q.none()
-            for name in names:
-                tresult |= q.filter(name__iexact=name)
-            result &= tresult
+            result = result.annotate(lower_name=Lower('name')).filter(
+                lower_name__in=[x.lower() for x in names])
         if filenames:
-            tresult = q.none()
-            for name in filenames:
-                r = q.filter(recording__contains=name)
-                for entry in r.all():
-                    if os.path.basename(entry.recording.name) == name:
-                        tresult|=q.filter(id = entry.id)
-                
-            result &= tresult
+            result = result.filter(recording_basename__in=filenames)
+        if checksums:
+            result = result.filter(recording_checksum__in=[x.lower() for x in checksums])
 
+        result = filter_entry_tags(result, self.request.GET)
+        result = filter_entry_ranges(result, self.request.GET)
+        result, searched = filter_entry_search(result, self.request.GET)
+        result = order_entries(result, self.request.GET, searched)
 
         return result
 
+    @action(detail=True)
+    def peaks(self, request, pk=None):
+        """
+        The binary waveform peaks file for the entry's recording
+        """
+        entry = get_object_or_404(PatchEntry, pk=pk)
+        if not entry.peaks:
+            raise Http404('No peaks for this recording')
+        return FileResponse(entry.peaks.open('rb'), content_type='application/octet-stream')
+
        
 
-class PatchAuthorAPIVS(APIDryRun, viewsets.ReadOnlyModelViewSet):
+class PatchAuthorAPIVS(ConditionalGetMixin, APIDryRun, viewsets.ReadOnlyModelViewSet):
     queryset = PatchAuthorName.objects.all()
     serializer_class = PatchAuthorSerializer
 
@@ -117,6 +221,55 @@ class PatchAuthorAPIVS(APIDryRun, viewsets.ReadOnlyModelViewSet):
 
 
 
+class ResolveAPIView(APIView):
+    """
+    Look up many objects at once. POST a JSON object with any of
+        tags        - tag names, case-insensitive
+        authors     - author display names, case-insensitive
+        images      - image checksums
+        attachments - attachment checksums
+        recordings  - recording filenames
+    Each type is one IN query. The response has, for each type given,
+    every match under "found" and the values that matched nothing under
+    "missing". Nothing is paginated.
+    """
+    permission_classes = [permissions.AllowAny]
+
+    def post(self, request, format=None):
+        data = serializers.ResolveSerializer(data=request.data)
+        data.is_valid(raise_exception=True)
+        data = data.validated_data
+        context = {'request': request}
+
+        #type: (queryset, field, case-insensitive i.e. field is lowercase, serializer)
+        lookups = {
+            'tags': (models.PatchTag.objects.all(), 'lower_name', True, serializers.PatchTagSerializer),
+            'authors': (PatchAuthorName.objects.annotate(lower_name=Lower('display_name')), 'lower_name', True,
+                PatchAuthorSerializer),
+            'images': (models.PatchImages.objects.all(), 'checksum', False, serializers.PatchImageSerializer),
+            'attachments': (models.PatchAttachments.objects.all(), 'checksum', False, serializers.PatchAttachSerializer),
+            'recordings': (get_entry_queryset(), 'recording_basename', False, PatchEntrySerializer),
+            }
+
+        result = {}
+        for key, (q, field, ignore_case, serializer) in lookups.items():
+            values = data.get(key, None)
+            if values is None:
+                continue
+            if ignore_case:
+                values = {x.lower(): x for x in values}
+            else:
+                values = {x: x for x in values}
+            q = q.annotate(resolve_key=F(field))
+            found = list(q.filter(resolve_key__in=list(values.keys())))
+            found_keys = {x.resolve_key for x in found}
+            result[key] = {
+                'found': serializer(found, many=True, context=context).data,
+                'missing': [y for x, y in values.items() if x not in found_keys],
+                }
+
+        return Response(result)
+
 class ChecksumFilter:
      def get_queryset(self):
         q = super().get_queryset()
@@ -132,17 +285,19 @@ class ChecksumFilter:
 
         return result
 
-class PatchImageAPIVS(ChecksumFilter, APIDryRun, viewsets.ModelViewSet):
+class PatchImageAPIVS(ConditionalGetMixin, ChecksumFilter, APIDryRun, viewsets.ModelViewSet):
     queryset = models.PatchImages.objects.all()
     serializer_class = serializers.PatchImageSerializer
     permission_classes=[IsAuthorOrReadOnly]
+    cache_generations = ('images',)
 
-class PatchAttachAPIVS(ChecksumFilter, APIDryRun, viewsets.ModelViewSet):
+class PatchAttachAPIVS(ConditionalGetMixin, ChecksumFilter, APIDryRun, viewsets.ModelViewSet):
     queryset = models.PatchAttachments.objects.all()
     serializer_class = serializers.PatchAttachSerializer
     permission_classes=[IsAuthorOrReadOnly]
+    cache_generations = ('attachments',)
 
-class PatchTagAPIVS(APIDryRun, viewsets.ModelViewSet):
+class PatchTagAPIVS(ConditionalGetMixin, APIDryRun, viewsets.ModelViewSet):
     queryset = models.PatchTag.objects.all()
     serializer_class = serializers.PatchTagSerializer
     permission_classes=[IsAuthorOrReadOnly]
@@ -159,34 +314,124 @@ class PatchTagAPIVS(APIDryRun, viewsets.ModelViewSet):
         return result
 
 
-def get_index_queryset(request):
-    order_map = {
-        'date': 'date',
-        'length': 'meta__duration'
-        }
+order_map = {
+    'date': 'date',
+    'length': 'duration',
+    'rating': 'rating',
+    'relevance': 'search_rank',
+    }
+
+#Orderings on fields that can be NULL
+nullable_orderings = {'duration', 'rating'}
+
+def filter_entry_ranges(q, params):
+    """
+    Apply the date and duration range filters in params to q. Invalid
+    values are ignored. max_date is inclusive of the whole day.
+    """
+    form = FilterForm(params)
+    form.is_valid()
+    data = form.cleaned_data
+
+    min_date = data.get('min_date', None)
+    max_date = data.get('max_date', None)
+    min_length = data.get('min_length', None)
+    max_length = data.get('max_length', None)
+
+    if min_date is not None:
+        q = q.filter(date__gte=date_to_datetime(min_date))
+    if max_date is not None:
+        q = q.filter(date__lt=date_to_datetime(max_date+datetime.timedelta(days=1)))
+    if min_length is not None:
+        q = q.filter(duration__gte=min_length)
+    if max_length is not None:
+        q = q.filter(duration__lte=max_length)
+
+    return q
+
+def filter_entry_tags(q, params):
+    """
+    Apply the tag filters in params to q
+        tags         - entries having all of the given tags
+        any_tags     - entries having at least one of the given tags
+        exclude_tags - entries having none of the given tags
+    Tag names are case-insensitive, matched on the indexed
+    PatchTag.lower_name. Each filter is a single subquery on the tag through
+    table regardless of the number of tags.
+    """
+    through = PatchEntry.tags.through
+
+    def matching(names):
+        names = {x.lower() for x in names}
+        result = through.objects.filter(patchtag__lower_name__in=names).order_by()
+        return names, result
+
+    all_tags = get_list_param(params, 'tags')
+    if all_tags:
+        names, matches = matching(all_tags)
+        matches = matches.values('patchentry_id').annotate(
+            n=Count('patchtag__lower_name', distinct=True)
+            ).filter(n=len(names))
+        q = q.filter(id__in=matches.values('patchentry_id'))
+
+    any_tags = get_list_param(params, 'any_tags')
+    if any_tags:
+        names, matches = matching(any_tags)
+        q = q.filter(id__in=matches.values('patchentry_id'))
+
+    exclude_tags = get_list_param(params, 'exclude_tags')
+    if exclude_tags:
+        names, matches = matching(exclude_tags)
+        q = q.exclude(id__in=matches.values('patchentry_id'))
+
+    return q
 
-    order_by = request.GET.get('order_by', 'date')
+def date_to_datetime(date):
+    """
+    Return the start of the given date in the current timezone
+    """
+    result = datetime.datetime.combine(date, datetime.time.min)
+    return timezone.make_aware(result)
+
+def filter_entry_search(q, params):
+    """
+    Apply the full-text search in params['q'] to q, annotating entries with
+    search_rank. Return (queryset, True if a search was applied)
+    """
+    text = params.get('q', '').strip()
+    if not search.tokenize(text):
+        return q, False
+    return search.search(q, text), True
+
+def order_entries(q, params, searched):
+    """
+    Order q by params['order_by'] and then id, descending unless
+    params['ascending'] is set. Defaults to relevance when searched and
+    date otherwise.
+    """
+    order_by = params.get('order_by', 'relevance' if searched else 'date')
     order_by = order_map.get(order_by, order_by)
-    ascending = request.GET.get('ascending', False)
-    if not ascending:
-        order_by = f'-{order_by}'
+    if order_by == 'search_rank' and not searched:
+        order_by = 'date'
+    ascending = params.get('ascending', False)
+    if order_by in nullable_orderings:
+        #Databases disagree on where NULLs sort, put them with the smallest
+        #values, see pagination.py
+        field = F(order_by).asc(nulls_first=True) if ascending else F(order_by).desc(nulls_last=True)
+        return q.order_by(field, 'id' if ascending else '-id')
+    if ascending:
+        return q.order_by(order_by, 'id')
+    return q.order_by(f'-{order_by}', '-id')
 
-    q = PatchEntry.objects.order_by(order_by)
+def get_index_queryset(request):
+    q, searched = filter_entry_search(get_entry_queryset(), request.GET)
+    q = order_entries(q, request.GET, searched)
 
     author = request.GET.get('author', False)
     if author:
         q = q.filter(authors__display_name=author)
-    tags = request.GET.get('tags', False)
-    if tags:
-        taglist = tags.split(',')
-        for tag in taglist:
-            q = q.filter(tags__name=tag)
-
-    min_date = request.GET.get('min_date', False)
-    max_date = request.GET.get('max_date', False)
-    min_length = request.GET.get('length', False)
-    max_length = request.GET.get('length', False)
-
+    q = filter_entry_tags(q, request.GET)
+    q = filter_entry_ranges(q, request.GET)
 
     return q
 
@@ -194,15 +439,15 @@ def get_index_queryset(request):
 from django import forms
 
 class FilterForm(forms.Form):
-    min_length = forms.DurationField(widget=forms.TimeInput)
-    max_length = forms.DurationField()
-    min_date = forms.DateField(widget=forms.DateInput)
-    max_date = forms.DateField(widget=forms.SelectDateWidget)
-    order_by = forms.ChoiceField(choices=[('test','date')])
-    ascending = forms.BooleanField()
+    min_length = forms.DurationField(widget=forms.TimeInput, required=False)
+    max_length = forms.DurationField(required=False)
+    min_date = forms.DateField(widget=forms.DateInput, required=False)
+    max_date = forms.DateField(widget=forms.SelectDateWidget, required=False)
+    order_by = forms.ChoiceField(choices=[(x, x) for x in order_map.keys()], required=False)
+    ascending = forms.BooleanField(required=False)
 
 
-class IndexView(generic.ListView):
+class IndexView(caching.AnonymousCacheMixin, generic.ListView):
     template_name = 'patches/index.html'
     context_object_name = 'patch_entries'
 
@@ -217,21 +462,18 @@ class IndexView(generic.ListView):
         except ObjectDoesNotExist:
             
             pass
-        tags = self.request.GET.get('tags', False)
-        if tags:
-            context['taglist'] = tags.split(',')
-        else:
-            context['taglist'] = []
+        context['taglist'] = get_list_param(self.request.GET, 'tags')
 
         context['filter_form'] = FilterForm()
 
-        duration = datetime.timedelta()
-        for x in context['patch_entries']:
-            duration += x.meta.duration
+        #Entries without metadata have no duration
+        duration = sum((x.duration for x in context['patch_entries'] if x.duration is not None),
+            datetime.timedelta())
 
         duration -= datetime.timedelta(microseconds=duration.microseconds)
 
         context['duration'] = duration
+        context['keyset'] = isinstance(context['page_obj'], pagination.KeysetPage)
 
 #        messages.add_message(self.request, messages.INFO, tttcms_tags.format_querystring(self.request.GET))
         return context
@@ -240,6 +482,30 @@ class IndexView(generic.ListView):
         q = get_index_queryset(self.request)
         return q
 
+    def use_keyset(self, queryset):
+        """
+        Page with cursors when following a cursor link or when
+        PATCHES_INDEX_KEYSET is set, if the ordering allows it
+        """
+        if pagination.get_keyset_ordering(queryset) is None:
+            return False
+        return 'cursor' in self.request.GET or getattr(settings, 'PATCHES_INDEX_KEYSET', False)
+
+    def get_paginator(self, queryset, per_page, **kwargs):
+        count_key = pagination.get_count_key(self.request, 'pages', self.page_kwarg)
+        return pagination.ApproximateCountPaginator(queryset, per_page, count_key=count_key, **kwargs)
+
+    def paginate_queryset(self, queryset, page_size):
+        if not self.use_keyset(queryset):
+            return super(IndexView, self).paginate_queryset(queryset, page_size)
+        cursor = self.request.GET.get('cursor') or None
+        count_key = pagination.get_count_key(self.request, 'keyset', 'cursor', self.page_kwarg)
+        try:
+            page = pagination.paginate_keyset(queryset, cursor, page_size, count_key)
+        except pagination.InvalidCursor:
+            raise Http404('Invalid cursor')
+        return (None, page, page.object_list, page.has_other_pages())
+
 class MyRSSFeed(Rss201rev2Feed):
     def add_item_elements(self, handler, item):
         handler.startElement(u'content:encoded', {})
@@ -249,9 +515,36 @@ class MyRSSFeed(Rss201rev2Feed):
         super(MyRSSFeed, self).add_item_elements(handler, item)
 
 class IndexFeed(Feed):
+    """
+    Feeds are cached per querystring until an entry changes, and served
+    with an ETag and Last-Modified so pollers get 304s
+    """
     title = 'New Audio Files'
     description = 'New audio files uploaded to the website'
     feed_type = MyRSSFeed
+    cache_timeout = 60*60
+    items_per_page = 10
+
+    def __call__(self, request, *args, **kwargs):
+        generation = caching.get_generation('entries')
+        last_modified = int(generation)
+        #Links in the feed are absolute, so the host is part of the key
+        key = caching.make_key('rss', generation, request.scheme, request.get_host(),
+            tttcms_tags.sorted_querystring(request.GET))
+        etag = quote_etag(key)
+
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            cached = cache.get(key)
+            if cached is None:
+                response = super(IndexFeed, self).__call__(request, *args, **kwargs)
+                cache.set(key, (response.content, response['Content-Type']), self.cache_timeout)
+            else:
+                content, content_type = cached
+                response = HttpResponse(content, content_type=content_type)
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        return response
 
     def get_object(self, request):
         self.request = request
@@ -265,7 +558,7 @@ class IndexFeed(Feed):
         return url
 
     def item_description(self, item):
-        desc =  tttcms_tags.render_markdown(item.desc)
+        desc = tttcms_tags.stored_markdown(item, 'desc')
         return desc
 
     def item_link(self, item):
@@ -275,14 +568,17 @@ class IndexFeed(Feed):
 
     def items(self, obj):
         q = get_index_queryset(obj)
-        q  = q[:10]
+        q  = q[:self.items_per_page]
         return q
 
     def item_enclosures(self, item):
-        mime_type = mimetypes.guess_type(item.recording.path)[0]
-        url = self.request.build_absolute_uri(item.recording.url)
-        length = str(item.recording.file.size)
-        return [Enclosure(url=url, length=length, mime_type=mime_type)]
+        #Stored on upload, see PatchEntry.save, so the feed never stats files
+        mime_type = item.recording_mime or mimetypes.guess_type(item.recording.name)[0]
+        size = item.recording_size
+        if size is None:
+            size = item.recording.size
+        url = self.request.build_absolute_uri(reverse('patches:recording', kwargs={'pk': item.id}))
+        return [Enclosure(url=url, length=str(size), mime_type=mime_type)]
 
     def item_author_name(self, item):
         return ', '.join(map(lambda x: x.display_name, item.authors.all()))
@@ -294,10 +590,31 @@ class IndexFeed(Feed):
         return list(map(lambda x: x.name, item.tags.all()))
 
 
+@require_safe
+def download_recording(request, pk):
+    entry = get_object_or_404(PatchEntry.objects.only('recording', 'recording_checksum', 'recording_basename'), pk=pk)
+    return downloads.serve_file(request, entry.recording, checksum=entry.recording_checksum,
+        filename=entry.recording_basename)
+
+@require_safe
+def download_image(request, pk):
+    image = get_object_or_404(models.PatchImages, pk=pk)
+    return downloads.serve_file(request, image.image, checksum=image.checksum)
+
+@require_safe
+def download_attachment(request, pk):
+    attachment = get_object_or_404(models.PatchAttachments, pk=pk)
+    return downloads.serve_file(request, attachment.file, checksum=attachment.checksum,
+        filename=attachment.filename(), as_attachment=True)
+
+
 class DetailView(generic.DetailView):
     model = PatchEntry
     template_name = 'patches/detail.html'
 
+    def get_queryset(self):
+        return get_entry_queryset()
+
     def get_context_data(self, **kwargs):
         context = super(DetailView, self).get_context_data(**kwargs)
         entry = context['object']
@@ -305,24 +622,12 @@ class DetailView(generic.DetailView):
         print('!'*80)
         print(dir(entry.recording))
 
-        #Need all the cases where entry is A
-        #Also need all the cases where entry is B and there is no complement
-        answers = models.BinaryAnswer.objects.filter(question__slug='similar')
-        answers_a = list(answers.filter(entryA=entry))
-        answers_b = answers.filter(entryB=entry)
-        for b in answers_b:
-            complement = False
-            for a in answers_a:
-                if b.entryA == a.entryB:
-                    complement=True
-            if not complement:
-                answers_a.append(b)
-
-        answers = list(map(lambda x: x.get_merged(entry), answers_a))
-
-        answers = sorted(answers, key=lambda x: x.get_score(), reverse=True)
+        scores = models.PairScore.objects.filter(
+            Q(entry_low=entry) | Q(entry_high=entry),
+            question__slug='similar',
+            ).select_related('question', 'entry_low', 'entry_high').order_by('-score', '-count_a')[:3]
 
-        answers = answers[:3]
+        answers = [x.align(entry) for x in scores]
 
         context['similar'] = answers
 
@@ -341,10 +646,12 @@ class CompareView(generic.ListView):
         def get_options(self): return None
 
     def get_question(self):
-        try:
-            return BinaryQuestion.objects.get(pk=self.kwargs.get('pk', self.default_pk))
-        except ObjectDoesNotExist:
-            return None
+        if not hasattr(self, '_question'):
+            try:
+                self._question = BinaryQuestion.objects.get(pk=self.kwargs.get('pk', self.default_pk))
+            except ObjectDoesNotExist:
+                self._question = None
+        return self._question
 
     def get_context_data(self, **kwargs):
         context = super(CompareView, self).get_context_data(**kwargs)
@@ -387,19 +694,16 @@ class CompareView(generic.ListView):
 
         origin_hash = self.get_origin(request)
 
-        if request.POST['answer'][0] not in ['a','b']:
+        answer = request.POST.get('answer', '')
+        if answer not in ['a','b']:
             messages.add_message(request, messages.INFO, 
                 f'Comparison skipped at {datetime.datetime.now(datetime.timezone.utc).strftime("%H:%M:%S %Z")}')
         else:
-            is_answer_a = request.POST['answer'][0]=='a'
-            question_id = request.POST['question_id'][0]
-            entry_a_id = request.POST['entry_a_id'][0]
-            entry_b_id = request.POST['entry_b_id'][0]
-
-            #Get all the answers for this pair
-            answers = models.BinaryAnswer.objects.filter(
-                    Q(entryA_id=entry_a_id, entryB_id=entry_b_id)
-                    )
+            is_answer_a = answer=='a'
+            question_id = request.POST['question_id']
+            entry_a_id = request.POST['entry_a_id']
+            entry_b_id = request.POST['entry_b_id']
+
             """
             There can be equivalent answers under different conditions
             Consider two entries 0 and 1 submitted to a question
@@ -434,45 +738,32 @@ class CompareView(generic.ListView):
             different answers
             """
 
-            #filter to this question
-            answers = answers.filter(question_id=question_id)
-
-            if answers.count() == 0:
-                #Make a new answer if it doesn't exist
-                answer = models.BinaryAnswer(
-                    entryA_id=entry_a_id, 
-                    entryB_id=entry_b_id, 
-                    question_id = question_id)
-            else:
-                answer = answers[0]
-
-            #Generate the answer detail
-            answer_detail = models.BinaryResponseDetail(
-                    answer=answer, 
-                    selected_a = is_answer_a,
-                    origin = origin_hash
-                    )
-
-            #Update the answer values
-            if is_answer_a:
-                answer.count_a+=1
-            else:
-                answer.count_b+=1
+            if votebuffer.is_enabled():
+                #Queue the vote for flush_votes and skip the session write
+                #for the confirmation message
+                try:
+                    votebuffer.append_vote(
+                        question_id, entry_a_id, entry_b_id, is_answer_a, origin_hash)
+                except (ValueError, OSError) as e:
+                    messages.add_message(request, messages.ERROR, 
+                        f'Failed to record comparison response: {e}')
+                return HttpResponseRedirect(request.path)
 
             try:
-                answer.save()
-                answer_detail.save()
+                answer_detail = models.BinaryAnswer.record_vote(
+                    question_id, entry_a_id, entry_b_id, is_answer_a, origin_hash)
             except Exception as e:
                 messages.add_message(request, messages.ERROR, 
-                    'Failed to record comparison response: {e}')
+                    f'Failed to record comparison response: {e}')
             else:
+                ranking.schedule_refit()
                 messages.add_message(request, messages.SUCCESS, 
                     f'Comparison recorded at {answer_detail.date.strftime("%H:%M:%S %Z")}')
 
         return HttpResponseRedirect(request.path)
 
 
-class TagView(generic.ListView):
+class TagView(caching.AnonymousCacheMixin, generic.ListView):
     model =PatchTag 
     template_name = 'patches/tags.html'
     context_object_name = 'tags'
@@ -480,7 +771,7 @@ class TagView(generic.ListView):
     def get_queryset(self):
         q = super(TagView, self).get_queryset()
 
-        q = sorted(q.all(), key = lambda x: x.count(), reverse=True)
+        q = q.order_by('-entry_count', 'name')
 
         return q
 
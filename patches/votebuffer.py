@@ -0,0 +1,161 @@
+"""
+Buffered ingestion of comparison votes.
+
+When PATCHES_VOTE_BUFFER['ENABLED'] is set, CompareView.post appends each
+vote as a line of JSON to an append-only log instead of writing to the
+database. The flush_votes management command periodically moves the log
+aside and applies the votes in batches with BinaryAnswer.record_votes.
+
+Each vote is given a random vote_id that is stored on its
+BinaryResponseDetail, so votes that were already applied are skipped if a
+flush replays part of the log after a crash.
+"""
+import os
+import json
+import uuid
+import fcntl
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import BinaryAnswer, BinaryQuestion, BinaryResponseDetail, PatchEntry
+
+default_config = {
+    'ENABLED': False,
+    'PATH': os.path.join(settings.BASE_DIR, 'votes.log'),
+    'BATCH_SIZE': 500,
+    'FLUSH_INTERVAL': 5,
+    }
+
+def get_config():
+    config = dict(default_config)
+    config.update(getattr(settings, 'PATCHES_VOTE_BUFFER', {}))
+    return config
+
+def is_enabled():
+    return get_config()['ENABLED']
+
+def open_locked(path):
+    """
+    Open path for appending and hold an exclusive lock on it. If the file was
+    moved aside by a flush while waiting for the lock, reopen the new one.
+    """
+    while True:
+        fp = open(path, 'a')
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fp.fileno()).st_ino == os.stat(path).st_ino:
+                return fp
+        except FileNotFoundError:
+            pass
+        fp.close()
+
+def append_vote(question_id, entry_a_id, entry_b_id, selected_a, origin):
+    """
+    Append a vote to the log
+    """
+    vote = {
+        'vote_id': uuid.uuid4().hex,
+        'question_id': int(question_id),
+        'entry_a_id': int(entry_a_id),
+        'entry_b_id': int(entry_b_id),
+        'selected_a': bool(selected_a),
+        'origin': origin,
+        'date': timezone.now().isoformat(),
+        }
+    line = json.dumps(vote)+'\n'
+    fp = open_locked(get_config()['PATH'])
+    try:
+        fp.write(line)
+        fp.flush()
+    finally:
+        fp.close()
+
+def read_votes(path, offset=0):
+    """
+    Return the votes in the log at path starting at byte offset, as a list of
+    (vote, end offset) pairs
+    """
+    result = []
+    with open(path, 'rb') as fp:
+        fp.seek(offset)
+        for line in fp:
+            offset += len(line)
+            try:
+                vote = json.loads(line)
+            except ValueError:
+                continue
+            vote['date'] = parse_datetime(vote['date'])
+            result.append((vote, offset))
+    return result
+
+def discard_invalid(votes):
+    """
+    Drop votes referring to questions or entries that no longer exist so
+    that one bad vote can't fail a whole batch
+    """
+    question_ids = {x['question_id'] for x in votes}
+    entry_ids = {x['entry_a_id'] for x in votes} | {x['entry_b_id'] for x in votes}
+    question_ids = set(BinaryQuestion.objects.filter(id__in=question_ids).values_list('id', flat=True))
+    entry_ids = set(PatchEntry.objects.filter(id__in=entry_ids).values_list('id', flat=True))
+    return [x for x in votes
+        if x['question_id'] in question_ids
+        and x['entry_a_id'] in entry_ids
+        and x['entry_b_id'] in entry_ids
+        ]
+
+def discard_applied(votes):
+    """
+    Drop votes that have already been recorded. Votes logged without a
+    vote_id are always kept.
+    """
+    vote_ids = [x['vote_id'] for x in votes if x.get('vote_id')]
+    applied = set(BinaryResponseDetail.objects.filter(vote_id__in=vote_ids).values_list('vote_id', flat=True))
+    return [x for x in votes if x.get('vote_id') not in applied]
+
+def flush(batch_size=None):
+    """
+    Move the log aside and apply its votes in batches. The position of the
+    last applied batch is checkpointed so that a flush interrupted part way
+    resumes where it stopped, and votes recorded after the last checkpoint
+    are skipped by vote_id. Return the number of votes applied.
+    """
+    config = get_config()
+    if batch_size is None:
+        batch_size = config['BATCH_SIZE']
+    path = config['PATH']
+    flushing = path+'.flushing'
+    checkpoint = path+'.checkpoint'
+
+    if not os.path.exists(flushing):
+        if not os.path.exists(path):
+            return 0
+        fp = open_locked(path)
+        try:
+            os.rename(path, flushing)
+        finally:
+            fp.close()
+
+    offset = 0
+    if os.path.exists(checkpoint):
+        with open(checkpoint) as fp:
+            offset = int(fp.read() or 0)
+
+    votes = read_votes(flushing, offset)
+    applied = 0
+    for start in range(0, len(votes), batch_size):
+        batch = votes[start:start+batch_size]
+        with transaction.atomic():
+            valid = discard_applied(discard_invalid([x for x, _ in batch]))
+            if valid:
+                BinaryAnswer.record_votes(valid)
+        applied += len(valid)
+        with open(checkpoint, 'w') as fp:
+            fp.write(str(batch[-1][1]))
+
+    os.remove(flushing)
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return applied
@@ -0,0 +1,196 @@
+"""
+Precomputed waveform peaks for recordings.
+
+A recording is decoded once, in chunks, and reduced to the minimum and
+maximum sample of each bucket of samples_per_bucket samples. Coarser zoom
+levels are built by merging pairs of buckets. The result is stored as a
+compact binary file next to the recording:
+
+    header  '<8sHBBIIH'  magic, version, bits, channels, sample rate,
+                         samples per bucket at level 0, number of levels
+    levels  '<I' * n     number of buckets in each level
+    data                 for each level, interleaved (min, max) pairs as
+                         little-endian int8 or int16
+
+Level n has buckets of samples_per_bucket * 2**n samples.
+"""
+import io
+import wave
+import struct
+import shutil
+import subprocess
+
+import numpy as np
+
+magic = b'TTTPEAKS'
+version = 1
+header_format = '<8sHBBIIH'
+
+samples_per_bucket = 256
+#Stop adding zoom levels when a level has this many buckets or fewer
+min_buckets = 256
+chunk_frames = 256*4096
+
+def read_wav(path):
+    """
+    Yield (sample_rate, samples) for the wav at path, where samples is a
+    (frames, channels) float32 array scaled to [-1, 1]
+    """
+    with wave.open(path, 'rb') as fp:
+        channels = fp.getnchannels()
+        width = fp.getsampwidth()
+        rate = fp.getframerate()
+        while True:
+            data = fp.readframes(chunk_frames)
+            if not data:
+                break
+            if width == 1:
+                samples = (np.frombuffer(data, dtype=np.uint8).astype(np.float32)-128)/128
+            elif width == 2:
+                samples = np.frombuffer(data, dtype='<i2').astype(np.float32)/2**15
+            elif width == 3:
+                raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+                raw = raw[:,0] | (raw[:,1] << 8) | (raw[:,2] << 16)
+                raw = np.where(raw >= 2**23, raw-2**24, raw)
+                samples = raw.astype(np.float32)/2**23
+            elif width == 4:
+                samples = np.frombuffer(data, dtype='<i4').astype(np.float32)/2**31
+            else:
+                raise ValueError(f'Unsupported sample width {width}')
+            yield rate, samples.reshape(-1, channels)
+
+def read_ffmpeg(path, rate=44100):
+    """
+    Yield (sample_rate, samples) for any file ffmpeg can decode, streamed
+    from ffmpeg as mono 16 bit samples
+    """
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        raise RuntimeError('ffmpeg is required to decode non-wav recordings')
+    command = [ffmpeg, '-v', 'error', '-i', path, '-f', 's16le', '-ac', '1', '-ar', str(rate), '-']
+    with subprocess.Popen(command, stdout=subprocess.PIPE) as proc:
+        while True:
+            data = proc.stdout.read(chunk_frames*2)
+            if not data:
+                break
+            if len(data) % 2:
+                data += proc.stdout.read(1)
+            samples = np.frombuffer(data, dtype='<i2').astype(np.float32)/2**15
+            yield rate, samples.reshape(-1, 1)
+        if proc.wait() != 0:
+            raise RuntimeError(f'ffmpeg failed to decode {path}')
+
+def read_audio(path):
+    if path.lower().endswith('.wav'):
+        try:
+            #Check the format up front, e.g. float wavs need ffmpeg
+            wave.open(path, 'rb').close()
+        except wave.Error:
+            pass
+        else:
+            return read_wav(path)
+    return read_ffmpeg(path)
+
+def compute_peaks(chunks, bucket=samples_per_bucket):
+    """
+    Reduce a stream of (sample_rate, samples) chunks to per-bucket minima
+    and maxima. Only one chunk and a partial bucket are held in memory.
+    Return (sample_rate, channels, mins, maxs)
+    """
+    mins = []
+    maxs = []
+    rate = 0
+    channels = 0
+    carry = np.zeros((0, 1), dtype=np.float32)
+    for rate, samples in chunks:
+        channels = samples.shape[1]
+        #Mix down to the envelope across channels
+        low = samples.min(axis=1)
+        high = samples.max(axis=1)
+        if len(carry):
+            low = np.concatenate([carry[:,0], low])
+            high = np.concatenate([carry[:,1], high])
+        whole = len(low)//bucket*bucket
+        if whole:
+            mins.append(low[:whole].reshape(-1, bucket).min(axis=1))
+            maxs.append(high[:whole].reshape(-1, bucket).max(axis=1))
+        carry = np.stack([low[whole:], high[whole:]], axis=1)
+
+    if len(carry):
+        mins.append(carry[:,0].min(keepdims=True))
+        maxs.append(carry[:,1].max(keepdims=True))
+
+    if not mins:
+        return rate, channels, np.zeros(0, np.float32), np.zeros(0, np.float32)
+    return rate, channels, np.concatenate(mins), np.concatenate(maxs)
+
+def build_levels(mins, maxs):
+    """
+    Return a list of (mins, maxs) zoom levels, each half the resolution of
+    the one before
+    """
+    levels = [(mins, maxs)]
+    while len(mins) > min_buckets:
+        if len(mins) % 2:
+            mins = np.append(mins, mins[-1])
+            maxs = np.append(maxs, maxs[-1])
+        mins = mins.reshape(-1, 2).min(axis=1)
+        maxs = maxs.reshape(-1, 2).max(axis=1)
+        levels.append((mins, maxs))
+    return levels
+
+def encode(rate, channels, levels, bits=8):
+    """
+    Return the peaks file for the given levels as bytes
+    """
+    if bits == 8:
+        dtype, scale = '<i1', 127
+    elif bits == 16:
+        dtype, scale = '<i2', 32767
+    else:
+        raise ValueError(f'Unsupported bit depth {bits}')
+
+    out = io.BytesIO()
+    out.write(struct.pack(header_format, magic, version, bits, channels,
+        rate, samples_per_bucket, len(levels)))
+    out.write(struct.pack(f'<{len(levels)}I', *[len(x) for x, _ in levels]))
+    for mins, maxs in levels:
+        data = np.empty(len(mins)*2, dtype=np.float32)
+        data[0::2] = mins
+        data[1::2] = maxs
+        data = np.clip(np.round(data*scale), -scale, scale).astype(dtype)
+        out.write(data.tobytes())
+    return out.getvalue()
+
+def decode(data):
+    """
+    Parse a peaks file. Return (header dict, list of (mins, maxs) levels)
+    with values as integers in the file's bit depth.
+    """
+    size = struct.calcsize(header_format)
+    name, file_version, bits, channels, rate, bucket, count = struct.unpack(header_format, data[:size])
+    if name != magic:
+        raise ValueError('Not a peaks file')
+    lengths = struct.unpack(f'<{count}I', data[size:size+4*count])
+    dtype = '<i1' if bits == 8 else '<i2'
+    offset = size+4*count
+    levels = []
+    for length in lengths:
+        values = np.frombuffer(data, dtype=dtype, count=length*2, offset=offset)
+        offset += values.nbytes
+        levels.append((values[0::2], values[1::2]))
+    header = {
+        'version': file_version,
+        'bits': bits,
+        'channels': channels,
+        'sample_rate': rate,
+        'samples_per_bucket': bucket,
+        }
+    return header, levels
+
+def generate_peaks(path, bits=8):
+    """
+    Decode the recording at path and return its peaks file as bytes
+    """
+    rate, channels, mins, maxs = compute_peaks(read_audio(path))
+    return encode(rate, channels, build_levels(mins, maxs), bits=bits)
@@ -177,6 +177,40 @@ THUMBNAIL_ALIASES = {
     }        
 }
 
+#Shared between worker processes. Pages, fragments, comparison pools and
+#counts go in default. patches/caching.py keeps its generation counters in
+#their own cache so culling default never evicts them.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(DATA_DIR, 'cache', 'default'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 50000,
+            'CULL_FREQUENCY': 10,
+            },
+    },
+    'generations': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(DATA_DIR, 'cache', 'generations'),
+        'TIMEOUT': None,
+    },
+}
+
+#Lock files shared between worker processes, see patches/caching.py. The
+#file cache's add isn't atomic so it can't be used for locks.
+PATCHES_LOCK_DIR = os.path.join(DATA_DIR, 'cache', 'locks')
+
+#Uploads are hashed as they stream in, see patches/uploadhandlers.py
+FILE_UPLOAD_HANDLERS = [
+    'patches.uploadhandlers.ChecksumMemoryFileUploadHandler',
+    'patches.uploadhandlers.ChecksumTemporaryFileUploadHandler',
+]
+
+#Thumbnails are generated in background threads when a PatchImages is saved,
+#see patches/thumbnails.py
+PATCHES_THUMBNAIL_ASYNC = True
+PATCHES_THUMBNAIL_WORKERS = 2
+
 THUMBNAIL_PROCESSORS = (
     'easy_thumbnails.processors.colorspace',
     'easy_thumbnails.processors.autocrop',
@@ -184,6 +218,34 @@ THUMBNAIL_PROCESSORS = (
     'easy_thumbnails.processors.filters'
 )
 
+#Buffered comparison votes, see patches/votebuffer.py
+#Run the flush_votes management command alongside the web workers when enabled
+PATCHES_VOTE_BUFFER = {
+    'ENABLED': False,
+    'PATH': os.path.join(DATA_DIR, 'votes.log'),
+    'BATCH_SIZE': 500,
+    'FLUSH_INTERVAL': 5,
+    }
+
+#Offload recording, image and attachment downloads to the front proxy, see
+#patches/downloads.py. One of None, 'x-accel-redirect' or 'x-sendfile'
+PATCHES_SENDFILE = None
+#nginx internal location serving MEDIA_ROOT when using x-accel-redirect
+PATCHES_SENDFILE_URL = '/protected-media/'
+
+#Slug of the BinaryQuestion whose answers define PatchEntry.rating
+PATCHES_RATING_QUESTION = 'better'
+#Minimum seconds between rating refits after unbuffered votes
+PATCHES_RATING_REFIT_INTERVAL = 60
+#Refit in a background thread rather than in the voting request
+PATCHES_RATING_REFIT_ASYNC = True
+
+#'terms', 'mysql' or 'auto', see patches/search.py
+PATCHES_SEARCH_BACKEND = 'auto'
+
+#Page the index with cursors instead of page numbers, see patches/pagination.py
+PATCHES_INDEX_KEYSET = False
+
 REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES'    : [
         'rest_framework.permissions.DjangoModelPermissionsOrAnonReadOnly',
@@ -194,3 +256,11 @@ REST_FRAMEWORK = {
 
 
 from .secret_configs import *
+
+#SQLite's default test database is shared in memory and locks whole tables
+#without waiting, so tests writing from several threads fail. Use a file
+#and wait for locks instead, as the site's own database does.
+for database in DATABASES.values():
+    if database['ENGINE'] == 'django.db.backends.sqlite3':
+        database.setdefault('TEST', {}).setdefault('NAME', os.path.join(DATA_DIR, 'cache', 'test.sqlite3'))
+        database.setdefault('OPTIONS', {}).setdefault('timeout', 20)
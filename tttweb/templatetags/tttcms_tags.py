@@ -2,6 +2,8 @@ from django import template
 from django.utils.http import urlencode
 import markdown
 import urllib
+import functools
+import threading
 
 register = template.Library()
 
@@ -9,15 +11,66 @@ register = template.Library()
 def is_expanded(value):
     return value.ancestor or value.selected
 
+markdown_state = threading.local()
+
+def get_markdown():
+    """
+    Return this thread's Markdown converter, creating it on first use.
+    Building one loads every extension, so they are reused.
+    """
+    md = getattr(markdown_state, 'md', None)
+    if md is None:
+        md = markdown.Markdown(extensions=['extra', 'sane_lists', 'nl2br'])
+        markdown_state.md = md
+    return md
+
+@functools.lru_cache(maxsize=1024)
+def convert_markdown(value):
+    md = get_markdown()
+    try:
+        return md.convert(value)
+    finally:
+        md.reset()
+
 @register.filter(name='render_markdown')
 def render_markdown(value):
     if value == None: return ''
-    md = markdown.Markdown(extensions=['extra', 'sane_lists', 'nl2br'])
-    return md.convert(value)
+    return convert_markdown(value)
+
+@register.filter(name='stored_markdown')
+def stored_markdown(obj, field):
+    """
+    Rendered markdown of obj.field, using the html stored in obj.field_html
+    when there is one
+    """
+    html = getattr(obj, f'{field}_html', None)
+    if html is not None:
+        return html
+    value = getattr(obj, field, None)
+    if callable(value):
+        value = value()
+    return render_markdown(value)
+
+@register.filter(name='stored_thumbnail_url')
+def stored_thumbnail_url(image, alias):
+    """
+    Thumbnail url of a PatchImages for the alias, using the url stored when
+    the image was saved
+    """
+    if not image: return ''
+    return image.get_thumbnail_url(alias)
+
+@register.filter(name='sorted_querystring')
+def sorted_querystring(query, keep_blank=False):
+    """
+    Querystring of a QueryDict with the keys and values sorted and empty
+    values dropped unless keep_blank, for use in cache keys
+    """
+    items = sorted((key, value) for key in query for value in query.getlist(key) if keep_blank or value != '')
+    return urlencode(items)
 
 @register.filter(name='page_range')
 def page_range(page_obj):
-    return range(1,100)
     return range(1,page_obj.paginator.num_pages+1)
 
 @register.simple_tag
@@ -56,6 +56,8 @@ class TTTAPI():
         """
         self.base_url = base_url + '/en/audio'
         self.auth = auth
+        #url: last 200 response with an ETag, see get
+        self.cache = {}
 
     def post(self, target, dry = True, **kwargs):
         """
@@ -70,17 +72,42 @@ class TTTAPI():
         return r
 
     def get(self, target, **kwargs):
-        r = requests.get(self.url(target), **kwargs)
+        """
+        GET with a local cache. Cached responses are revalidated with
+        If-None-Match and If-Modified-Since and reused on a 304.
+        """
+        url = requests.Request('GET', self.url(target), params=kwargs.pop('params', None)).prepare().url
+        headers = dict(kwargs.pop('headers', None) or {})
+        cached = self.cache.get(url)
+        if cached is not None:
+            headers['If-None-Match'] = cached.headers['ETag']
+            if 'Last-Modified' in cached.headers:
+                headers['If-Modified-Since'] = cached.headers['Last-Modified']
+
+        r = requests.get(url, headers=headers, **kwargs)
+        if r.status_code == 304 and cached is not None:
+            return cached
+        if r.status_code == 200 and 'ETag' in r.headers:
+            self.cache[url] = r
         return r
 
+    def resolve(self, **lists):
+        """
+        Look up lists of tags, authors, images, attachments (by checksum) and
+        recordings (by filename) in one request. Return a dictionary of
+        type: {'found': [objects], 'missing': [values]}
+        """
+        r = requests.post(self.url('resolve'), json=lists, auth=self.auth)
+        r.raise_for_status()
+        return r.json()
+
     def get_name(self, name):
         r = self.get('entries', params={'names': [name]})
         return r.json()['results']
 
     def get_recording_name(self, name):
         name = os.path.basename(name)
-        r = self.get('entries', params={'filenames': [name]})
-        return r.json()['results']
+        return self.resolve(recordings=[name])['recordings']['found']
 
     def get_files(self, target, filenames):
         """
@@ -97,8 +124,7 @@ class TTTAPI():
                 checksum = generate_checksum(f)
                 hashmap[checksum] = filename
         hashes = list(hashmap.keys())
-        r = self.get(target, params={'checksums':hashes})
-        found_files = r.json()
+        found_files = self.resolve(**{target: hashes})[target]['found']
         found_names =list(map(lambda x: hashmap[x['checksum']], found_files))
         missing_files = []
         for filename in filenames:
@@ -117,14 +143,8 @@ class TTTAPI():
         """
         find authors matching the given list of display names
         """
-        r = self.get('authors', params = {'display_name': auths})
-        found_auths = r.json()['results']
-        found_names = list(map(lambda x: x['display_name'], found_auths))
-        missing_auths = []
-        for auth in auths:
-            if not auth in found_names:
-                missing_auths.append(auth)
-        return found_auths, missing_auths
+        result = self.resolve(authors=auths)['authors']
+        return result['found'], result['missing']
 
 
 
@@ -136,14 +156,8 @@ class TTTAPI():
         found_tags = list of tag dictionaries
         missing_tags = list of tab names not found
         """
-        r = self.get('tags', params = {'name': tags})
-        found_tags = r.json()['results']
-        found_names = list(map(lambda x: x['name'].lower(), found_tags))
-        missing_tags = []
-        for tag in tags:
-            if not tag.lower() in found_names:
-                missing_tags.append(tag)
-        return found_tags, missing_tags
+        result = self.resolve(tags=tags)['tags']
+        return result['found'], result['missing']
 
 
     def handle_missing_tags(self, tags):
@@ -80,6 +80,16 @@ class Uploader():
         r = requests.get(self.url(target), **kwargs)
         return r
 
+    def resolve(self, **lists):
+        """
+        Look up lists of tags, authors, images, attachments (by checksum) and
+        recordings (by filename) in one request. Return a dictionary of
+        type: {'found': [objects], 'missing': [values]}
+        """
+        r = requests.post(self.url('resolve'), json=lists, auth=self.auth)
+        r.raise_for_status()
+        return r.json()
+
     def dry_run(self):
         """
         Dry run test of uploading parts
@@ -173,8 +183,7 @@ class Uploader():
                 checksum = generate_checksum(f)
                 hashmap[checksum] = filename
         hashes = list(hashmap.keys())
-        r = self.get(target, params={'checksums':hashes})
-        found_files = r.json()['results']
+        found_files = self.resolve(**{target: hashes})[target]['found']
         found_names =list(map(lambda x: hashmap[x['checksum']], found_files))
         missing_files = []
         for filename in filenames:
@@ -198,14 +207,8 @@ class Uploader():
         """
         if tags == None:
             tags = self.data['tags']
-        r = self.get('tags', params = {'name': tags})
-        found_tags = r.json()['results']
-        found_names = list(map(lambda x: x['name'].lower(), found_tags))
-        missing_tags = []
-        for tag in tags:
-            if not tag.lower() in found_names:
-                missing_tags.append(tag)
-        return found_tags, missing_tags
+        result = self.resolve(tags=tags)['tags']
+        return result['found'], result['missing']
 
     def handle_missing_tags(self, tags):
         """